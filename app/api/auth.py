@@ -1,67 +1,40 @@
-from fastapi import Depends, Header, HTTPException
+from fastapi import Depends, Header
 from typing import Optional, Annotated
-from app.utils.security import validate_api_key, ImageServiceError
+from app.utils.security import http_error
+from app.utils.security_cache import validate_api_key_cached
 
-async def get_api_key(x_api_key: Annotated[Optional[str], Header(alias="X-API-Key")] = None) -> str:
-    """從 Header 中獲取並驗證 API Key"""
+async def get_api_key_context(x_api_key: Annotated[Optional[str], Header(alias="X-API-Key")] = None) -> dict:
+    """從 Header 中獲取並驗證 API Key，一次返回 Key 與其配置"""
     if not x_api_key:
-        raise HTTPException(
+        raise http_error(
+            code="AUTH_REQUIRED",
+            message="API key is required",
             status_code=401,
-            detail={
-                "error": {
-                    "code": "AUTH_REQUIRED",
-                    "message": "API key is required",
-                    "details": "Please provide X-API-Key header"
-                }
-            }
+            details="Please provide X-API-Key header"
         )
     
-    try:
-        # 驗證 API Key
-        validate_api_key(x_api_key)
-        return x_api_key
-    except ImageServiceError as e:
-        raise HTTPException(
-            status_code=e.status_code,
-            detail={
-                "error": {
-                    "code": e.code,
-                    "message": e.message,
-                    "details": e.details
-                }
-            }
-        )
+    # 驗證 API Key
+    config = validate_api_key_cached(x_api_key)
+    return {"api_key": x_api_key, "config": config}
+
+async def get_api_key(context: dict = Depends(get_api_key_context)) -> str:
+    """獲取已驗證的 API Key"""
+    return context["api_key"]
 
-async def get_api_key_config(api_key: str = Depends(get_api_key)) -> dict:
+async def get_api_key_config(context: dict = Depends(get_api_key_context)) -> dict:
     """獲取 API Key 的配置資訊"""
-    return validate_api_key(api_key)
+    return context["config"]
 
 def verify_user_path_permission(user_path: str, api_key: str) -> bool:
     """驗證使用者路徑權限"""
-    try:
-        api_key_config = validate_api_key(api_key)
+    api_key_config = validate_api_key_cached(api_key)
+    
+    if not user_path.startswith(api_key_config["_prefix_tuple"]):
         allowed_prefix = api_key_config.get("allowed_prefix", "")
-        
-        if not user_path.startswith(allowed_prefix):
-            raise HTTPException(
-                status_code=403,
-                detail={
-                    "error": {
-                        "code": "PATH_FORBIDDEN",
-                        "message": "Path access denied",
-                        "details": f"Path must start with '{allowed_prefix}'"
-                    }
-                }
-            )
-        return True
-    except ImageServiceError as e:
-        raise HTTPException(
-            status_code=e.status_code,
-            detail={
-                "error": {
-                    "code": e.code,
-                    "message": e.message,
-                    "details": e.details
-                }
-            }
-        )
\ No newline at end of file
+        raise http_error(
+            code="PATH_FORBIDDEN",
+            message="Path access denied",
+            status_code=403,
+            details=f"Path must start with '{allowed_prefix}'"
+        )
+    return True
\ No newline at end of file
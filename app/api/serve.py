@@ -1,155 +1,220 @@
-from fastapi import APIRouter, Depends, Query, HTTPException
-from fastapi.responses import Response
-from typing import Optional
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import Response, FileResponse
+from typing import Optional, Dict, Tuple, Callable, Awaitable
+from cachetools import TTLCache
+import asyncio
+import hashlib
 
 from app.api.auth import get_api_key
+from app.services import get_storage_service, run_image_task
 from app.services.storage import StorageService
-from app.services.image_processor import ImageProcessor
+from app.services.image_processor import resize_image, validate_and_convert_format, ENCODE_PROFILES
 from app.utils.validators import validate_image_dimensions, validate_quality
-from app.utils.security import ImageServiceError
+from app.utils.security import http_error, ImageServiceError
+from app.config import VARIANT_CACHE_MAX_BYTES, VARIANT_CACHE_TTL, DEFAULT_ENCODE_PROFILE
 
 router = APIRouter(prefix="/api/v1/images", tags=["serve"])
 
-# 全域服務實例
-storage_service = StorageService()
-image_processor = ImageProcessor()
+# 格式對應的 MIME 類型（含 jpg 別名）及允許的調整模式
+_MIME_BY_FORMAT = {
+    'jpeg': 'image/jpeg',
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'gif': 'image/gif'
+}
+_DEFAULT_MIME_TYPE = 'image/jpeg'
+_ALLOWED_MODES = frozenset({"fit", "fill", "crop"})
+
+# 處理後圖片快取：(uuid, width, height, quality, format, mode, profile) -> (內容, 輸出格式)，以位元組數限制容量
+_variant_cache = TTLCache(
+    maxsize=VARIANT_CACHE_MAX_BYTES,
+    ttl=VARIANT_CACHE_TTL,
+    getsizeof=lambda value: len(value[0])
+)
+
+_CACHE_CONTROL = "public, max-age=3600"  # 1小時快取
+
+# 正在處理中的版本：同一版本的並發請求共用同一個 Future
+_inflight: Dict[tuple, asyncio.Future] = {}
+
+class _RenderAbandoned(Exception):
+    """負責處理的請求被取消，等待中的請求需自行接手處理"""
+
+def invalidate_image_variants(uuid: str):
+    """清除指定圖片所有處理後版本的快取"""
+    for key in [key for key in _variant_cache if key[0] == uuid]:
+        _variant_cache.pop(key, None)
+
+async def _render_variant(variant_key: tuple, render: Callable[[], Awaitable[Tuple[bytes, str]]]) -> Tuple[bytes, str]:
+    """合併相同版本的並發處理請求（singleflight），只有第一個請求實際處理"""
+    while (inflight := _inflight.get(variant_key)) is not None:
+        try:
+            # shield：等待者斷線只取消自己的等待，不會取消其他請求共用的 Future
+            return await asyncio.shield(inflight)
+        except _RenderAbandoned:
+            # 負責處理的請求已被取消，由此請求接手（或等待新的負責者）
+            continue
+    
+    future = asyncio.get_running_loop().create_future()
+    # 沒有其他等待者時，避免 "exception was never retrieved" 警告
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _inflight[variant_key] = future
+    try:
+        result = await render()
+        if len(result[0]) <= _variant_cache.maxsize:
+            _variant_cache[variant_key] = result
+        if not future.done():
+            future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        # 不取消共用的 Future，讓仍在等待的請求接手處理
+        if not future.done():
+            future.set_exception(_RenderAbandoned())
+        raise
+    except Exception as e:
+        if not future.done():
+            future.set_exception(e)
+        raise
+    finally:
+        if _inflight.get(variant_key) is future:
+            del _inflight[variant_key]
+
+def _variant_etag(uuid: str, width: Optional[int], height: Optional[int],
+                  quality: Optional[int], format: Optional[str], mode: Optional[str],
+                  profile: Optional[str]) -> str:
+    """計算圖片版本的強 ETag"""
+    variant_hash = hashlib.blake2b(
+        f"{uuid}:{width}:{height}:{quality}:{format}:{mode}:{profile}".encode(),
+        digest_size=8
+    ).hexdigest()
+    return f'"{uuid}-{variant_hash}"'
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """檢查 If-None-Match 是否符合 ETag（支援多值、* 及弱比對）"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
 
 @router.get("/{uuid}")
 async def get_image(
     uuid: str,
+    request: Request,
     width: Optional[int] = Query(None, description="Target width"),
     height: Optional[int] = Query(None, description="Target height"),
     quality: Optional[int] = Query(None, ge=1, le=100, description="Image quality (1-100)"),
     format: Optional[str] = Query(None, description="Output format (jpeg, png, webp)"),
     mode: Optional[str] = Query("fit", description="Resize mode (fit, fill, crop)"),
-    api_key: str = Depends(get_api_key)
+    profile: str = Query(DEFAULT_ENCODE_PROFILE, description="Encode profile (fast, balanced, archive)"),
+    api_key: str = Depends(get_api_key),
+    storage_service: StorageService = Depends(get_storage_service)
 ):
     """獲取圖片（支援動態調整大小）"""
-    try:
-        # 驗證參數
-        validate_image_dimensions(width, height)
-        if quality is not None:
-            validate_quality(quality)
-        
-        # 驗證調整模式
-        if mode not in ["fit", "fill", "crop"]:
-            raise ImageServiceError(
-                code="INVALID_MODE",
-                message="Invalid resize mode",
-                status_code=400,
-                details="Mode must be one of: fit, fill, crop"
-            )
-        
-        # 驗證並轉換輸出格式
-        if format:
-            format = image_processor.validate_and_convert_format(format)
+    # 驗證參數
+    validate_image_dimensions(width, height)
+    if quality is not None:
+        validate_quality(quality)
+    
+    # 驗證調整模式
+    if mode not in _ALLOWED_MODES:
+        raise ImageServiceError(
+            code="INVALID_MODE",
+            message="Invalid resize mode",
+            status_code=400,
+            details="Mode must be one of: fit, fill, crop"
+        )
+    
+    # 驗證編碼設定檔
+    if profile not in ENCODE_PROFILES:
+        raise ImageServiceError(
+            code="INVALID_PROFILE",
+            message="Invalid encode profile",
+            status_code=400,
+            details="Profile must be one of: fast, balanced, archive"
+        )
+    
+    # 驗證並轉換輸出格式
+    if format:
+        format = validate_and_convert_format(format)
+    
+    # 獲取圖片元數據
+    image_metadata, permitted = storage_service.metadata_manager.get_image_if_permitted(uuid, api_key)
+    if not image_metadata:
+        raise http_error(
+            code="IMAGE_NOT_FOUND",
+            message="Image not found",
+            status_code=404,
+            details=f"Image with UUID {uuid} does not exist"
+        )
+    
+    # 檢查權限
+    if not permitted:
+        raise http_error(
+            code="ACCESS_DENIED",
+            message="Access denied",
+            status_code=403,
+            details="You do not have permission to access this image"
+        )
+    
+    # 用戶端快取仍有效時直接返回 304，略過讀檔及處理
+    processed = bool(width or height or format or quality)
+    if processed:
+        etag = _variant_etag(uuid, width, height, quality or 85, format, mode, profile)
+    else:
+        etag = _variant_etag(uuid, None, None, None, None, None, None)
+    headers = {"Cache-Control": _CACHE_CONTROL, "ETag": etag}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    # 如果需要調整大小或格式，進行處理
+    if processed:
+        variant_key = (uuid, width, height, quality or 85, format, mode, profile)
+        cached_variant = _variant_cache.get(variant_key)
+        if cached_variant is not None:
+            processed_content, output_format = cached_variant
+        else:
+            async def render() -> Tuple[bytes, str]:
+                # 直接以路徑交給解碼器讀取原始檔案，不先整檔讀入記憶體
+                full_path = storage_service.get_full_path(image_metadata["file_path"])
+                
+                # 在圖片處理執行緒池中處理，避免阻塞事件迴圈
+                return await run_image_task(
+                    resize_image,
+                    file_content=full_path,
+                    width=width,
+                    height=height,
+                    quality=quality or 85,
+                    output_format=format,
+                    mode=mode,
+                    profile=profile
+                )
+            
+            processed_content, output_format = await _render_variant(variant_key, render)
         
-        # 獲取圖片元數據
-        image_metadata = storage_service.metadata_manager.get_image(uuid)
-        if not image_metadata:
-            raise HTTPException(
-                status_code=404,
-                detail={
-                    "error": {
-                        "code": "IMAGE_NOT_FOUND",
-                        "message": "Image not found",
-                        "details": f"Image with UUID {uuid} does not exist"
-                    }
-                }
-            )
+        # 設定正確的 MIME 類型
+        mime_type = _MIME_BY_FORMAT.get(output_format, _DEFAULT_MIME_TYPE)
         
-        # 檢查權限
-        if not storage_service.metadata_manager.check_image_permission(uuid, api_key):
-            raise HTTPException(
-                status_code=403,
-                detail={
-                    "error": {
-                        "code": "ACCESS_DENIED",
-                        "message": "Access denied",
-                        "details": "You do not have permission to access this image"
-                    }
-                }
-            )
+        headers["Content-Disposition"] = f"inline; filename=\"{uuid}.{output_format}\""
+        return Response(
+            content=processed_content,
+            media_type=mime_type,
+            headers=headers
+        )
+    else:
+        # 原始檔案路徑（不讀入記憶體，直接串流回應）
+        full_path = storage_service.get_full_path(image_metadata["file_path"])
         
-        # 讀取原始檔案
-        file_content = await storage_service.read_file(image_metadata["file_path"])
+        # 返回原始圖片
+        original_format = image_metadata.get("format", "JPEG").lower()
+        mime_type = _MIME_BY_FORMAT.get(original_format, _DEFAULT_MIME_TYPE)
         
-        # 如果需要調整大小或格式，進行處理
-        if width or height or format or quality:
-            processed_content, output_format = image_processor.resize_image(
-                file_content=file_content,
-                width=width,
-                height=height,
-                quality=quality or 85,
-                output_format=format,
-                mode=mode
-            )
-            
-            # 設定正確的 MIME 類型
-            mime_type_map = {
-                'jpeg': 'image/jpeg',
-                'png': 'image/png',
-                'webp': 'image/webp',
-                'gif': 'image/gif'
-            }
-            mime_type = mime_type_map.get(output_format, 'image/jpeg')
-            
-            return Response(
-                content=processed_content,
-                media_type=mime_type,
-                headers={
-                    "Cache-Control": "public, max-age=3600",  # 1小時快取
-                    "Content-Disposition": f"inline; filename=\"{uuid}.{output_format}\""
-                }
-            )
-        else:
-            # 返回原始圖片
-            original_format = image_metadata.get("format", "JPEG").lower()
-            format_ext_map = {
-                'jpeg': 'jpeg',
-                'jpg': 'jpeg', 
-                'png': 'png',
-                'gif': 'gif',
-                'webp': 'webp'
-            }
-            
-            format_key = format_ext_map.get(original_format, 'jpeg')
-            mime_type_map = {
-                'jpeg': 'image/jpeg',
-                'png': 'image/png', 
-                'webp': 'image/webp',
-                'gif': 'image/gif'
-            }
-            mime_type = mime_type_map.get(format_key, 'image/jpeg')
-            
-            return Response(
-                content=file_content,
-                media_type=mime_type,
-                headers={
-                    "Cache-Control": "public, max-age=3600",  # 1小時快取
-                    "Content-Disposition": f"inline; filename=\"{image_metadata['original_name']}\""
-                }
-            )
-    
-    except ImageServiceError as e:
-        raise HTTPException(
-            status_code=e.status_code,
-            detail={
-                "error": {
-                    "code": e.code,
-                    "message": e.message,
-                    "details": e.details
-                }
-            }
-        )
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "error": {
-                    "code": "INTERNAL_ERROR",
-                    "message": "Internal server error",
-                    "details": str(e)
-                }
-            }
+        headers["Content-Disposition"] = f"inline; filename=\"{image_metadata['original_name']}\""
+        return FileResponse(
+            full_path,
+            media_type=mime_type,
+            headers=headers
         )
\ No newline at end of file
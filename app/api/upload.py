@@ -1,114 +1,145 @@
 from fastapi import APIRouter, Depends, UploadFile, File, Form, BackgroundTasks
-from typing import List, Optional
-import uuid
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import logging
 import os
+import time
+import uuid
 from datetime import datetime
+from pydantic import TypeAdapter, ValidationError
 
 from app.api.auth import get_api_key, get_api_key_config
-from app.services.storage import StorageService, MetadataManager
-from app.services.image_processor import ImageProcessor
-from app.utils.validators import validate_file_content
-from app.utils.security import generate_uuid, sanitize_filename, ImageServiceError
+from app.services import get_storage_service, get_batch_progress_store, run_image_task
+from app.services.storage import StorageService
+from app.services.image_processor import probe_image_info
+from app.services.webhook import webhook_service
+from app.utils.validators import validate_file_content, FILE_HEADER_SIZE
+from app.utils.timestamps import utc_timestamp
+from app.utils.security import generate_uuid, sanitize_filename, validate_user_path, http_error, ImageServiceError
 from app.schemas.image import ImageUploadResponse, BatchUploadResponse, BatchProgressResponse, ImageInfo
-from app.config import MAX_BATCH_SIZE
+from app.config import MAX_BATCH_SIZE, BATCH_UPLOAD_CONCURRENCY, BATCH_PROGRESS_FLUSH_SIZE, BATCH_PROGRESS_FLUSH_INTERVAL, UPLOAD_DEDUP
 
 router = APIRouter(prefix="/api/v1/images", tags=["upload"])
+logger = logging.getLogger(__name__)
+
+# 檔名沒有副檔名時使用的預設副檔名
+_DEFAULT_EXTENSION = 'jpg'
+
+# webhook headers 驗證器（pydantic v2 直接由 JSON 字串解析並驗證）
+_WEBHOOK_HEADERS_ADAPTER = TypeAdapter(Dict[str, str])
 
-# 全域服務實例
-storage_service = StorageService()
-image_processor = ImageProcessor()
+def _join(directory: str, filename: str) -> str:
+    """串接儲存用的相對路徑（directory 需已去除結尾的 /）"""
+    return f"{directory}/{filename}"
 
-# 批次進度追蹤（內存存儲）
-batch_progress = {}
+async def _store_upload(file: UploadFile, file_size: int, user_path: str, base_path: str, api_key: str,
+                        storage_service: StorageService) -> Tuple[dict, bool]:
+    """保存已驗證的上傳檔案，返回 (待寫入的元數據, 是否保留了既有檔案的引用)；保留的引用由呼叫端寫入元數據後釋放"""
+    # 未啟用去重時不需要計算整個檔案的雜湊
+    content_hash = None
+    duplicate = None
+    if UPLOAD_DEDUP:
+        content_hash = await asyncio.to_thread(storage_service.content_hash, file.file)
+        duplicate = storage_service.metadata_manager.get_by_hash(api_key, content_hash)
+        if duplicate is not None:
+            # 查詢與保留之間沒有 await，原檔不會在此期間被刪除
+            storage_service.metadata_manager.reserve_file(duplicate["file_path"])
+    
+    # 生成 UUID 和檔案名
+    image_uuid = generate_uuid()
+    safe_filename = sanitize_filename(file.filename)
+    
+    if duplicate is not None:
+        relative_file_path = duplicate["file_path"]
+        image_info = {"format": duplicate["format"], "dimensions": duplicate["dimensions"]}
+    else:
+        # 獲取圖片資訊（只解析暫存檔標頭）
+        await file.seek(0)
+        image_info = await run_image_task(probe_image_info, file.file)
+        
+        _, sep, extension = safe_filename.rpartition('.')
+        file_extension = extension if sep else _DEFAULT_EXTENSION
+        storage_filename = f"{image_uuid}.{file_extension}"
+        
+        # 保存檔案
+        relative_file_path = _join(base_path, storage_filename)
+        await storage_service.save_stream(file.file, user_path, storage_filename)
+    
+    record = {
+        "uuid": image_uuid,
+        "file_path": relative_file_path,
+        "original_name": safe_filename,
+        "api_key": api_key,
+        "user_path": user_path,
+        "file_size": file_size,
+        "format_type": image_info['format'],
+        "dimensions": image_info['dimensions'],
+        "content_hash": content_hash
+    }
+    return record, duplicate is not None
+
+async def _discard_files(storage_service: StorageService, file_paths: List[str]):
+    """刪除元數據未能寫入的新檔案，避免留下沒有任何元數據引用的孤兒檔案"""
+    for file_path in file_paths:
+        try:
+            await asyncio.to_thread(storage_service.delete_file, file_path)
+        except Exception as e:
+            logger.error(f"Failed to remove orphaned file {file_path}: {e}")
+
+def _upload_size(file: UploadFile) -> int:
+    """獲取上傳檔案大小（不讀取內容；解析器未提供時由暫存檔位置計算）"""
+    if file.size is not None:
+        return file.size
+    file.file.seek(0, os.SEEK_END)
+    return file.file.tell()
 
 @router.post("/upload", response_model=ImageUploadResponse)
 async def upload_image(
     file: UploadFile = File(...),
     user_path: str = Form(...),
     api_key: str = Depends(get_api_key),
-    api_key_config: dict = Depends(get_api_key_config)
+    api_key_config: dict = Depends(get_api_key_config),
+    storage_service: StorageService = Depends(get_storage_service)
 ):
     """單張圖片上傳"""
+    # 驗證路徑權限
+    validate_user_path(user_path, api_key_config)
+    
+    # 只讀取檔案標頭，不將整個檔案載入記憶體
+    header = await file.read(FILE_HEADER_SIZE)
+    file_size = _upload_size(file)
+    
+    # 驗證檔案
+    validate_file_content(header, file.filename, file_size)
+    
+    # 保存檔案及元數據
+    record, reserved = await _store_upload(file, file_size, user_path, user_path.rstrip('/'), api_key, storage_service)
     try:
-        # 驗證路徑權限
-        allowed_prefix = api_key_config.get("allowed_prefix", "")
-        if not user_path.startswith(allowed_prefix):
-            raise ImageServiceError(
-                code="PATH_FORBIDDEN",
-                message="Path access denied",
-                status_code=403,
-                details=f"Path must start with '{allowed_prefix}'"
-            )
-        
-        # 讀取檔案內容
-        file_content = await file.read()
-        
-        # 驗證檔案
-        validate_file_content(file_content, file.filename)
-        
-        # 獲取圖片資訊
-        image_info = image_processor.get_image_info(file_content)
-        
-        # 生成 UUID 和檔案名
-        image_uuid = generate_uuid()
-        safe_filename = sanitize_filename(file.filename)
-        file_extension = safe_filename.split('.')[-1] if '.' in safe_filename else 'jpg'
-        storage_filename = f"{image_uuid}.{file_extension}"
-        
-        # 保存檔案
-        relative_file_path = os.path.join(user_path, storage_filename).replace('\\', '/')
-        await storage_service.save_file(file_content, user_path, storage_filename)
-        
-        # 保存元數據
-        metadata = storage_service.metadata_manager.add_image(
-            uuid=image_uuid,
-            file_path=relative_file_path,
-            original_name=safe_filename,
-            api_key=api_key,
-            user_path=user_path,
-            file_size=len(file_content),
-            format_type=image_info['format'],
-            dimensions=image_info['dimensions']
-        )
-        
-        # 構建回應
-        image_response = ImageInfo(
-            uuid=image_uuid,
-            original_name=safe_filename,
-            user_path=user_path,
-            file_size=len(file_content),
-            format=image_info['format'],
-            dimensions=image_info['dimensions'],
-            upload_time=datetime.fromisoformat(metadata['upload_time']),
-            access_url=f"/api/v1/images/{image_uuid}"
-        )
-        
-        return ImageUploadResponse(success=True, images=[image_response])
-        
-    except ImageServiceError as e:
-        from fastapi import HTTPException
-        raise HTTPException(
-            status_code=e.status_code,
-            detail={
-                "error": {
-                    "code": e.code,
-                    "message": e.message,
-                    "details": e.details
-                }
-            }
-        )
-    except Exception as e:
-        from fastapi import HTTPException
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "error": {
-                    "code": "INTERNAL_ERROR",
-                    "message": "Internal server error",
-                    "details": str(e)
-                }
-            }
-        )
+        await storage_service.sync_files([record["file_path"]])
+        # 日誌寫入含 fsync（及偶爾的快照合併），在工作執行緒中進行以免阻塞事件迴圈
+        metadata = await asyncio.to_thread(storage_service.metadata_manager.add_image, **record)
+    except Exception:
+        # 引用既有檔案時不可刪除；新保存的檔案沒有元數據引用，直接移除
+        if not reserved:
+            await _discard_files(storage_service, [record["file_path"]])
+        raise
+    finally:
+        if reserved:
+            storage_service.metadata_manager.release_file(record["file_path"])
+    
+    # 構建回應
+    image_response = ImageInfo(
+        uuid=record["uuid"],
+        original_name=record["original_name"],
+        user_path=user_path,
+        file_size=file_size,
+        format=record["format_type"],
+        dimensions=record["dimensions"],
+        upload_time=datetime.fromisoformat(metadata['upload_time']),
+        access_url=f"/api/v1/images/{record['uuid']}"
+    )
+    
+    return ImageUploadResponse(success=True, images=[image_response])
 
 @router.post("/batch-upload", response_model=BatchUploadResponse)
 async def batch_upload_images(
@@ -118,101 +149,81 @@ async def batch_upload_images(
     webhook_headers: Optional[str] = Form(None),
     background_tasks: BackgroundTasks = BackgroundTasks(),
     api_key: str = Depends(get_api_key),
-    api_key_config: dict = Depends(get_api_key_config)
+    api_key_config: dict = Depends(get_api_key_config),
+    progress_store = Depends(get_batch_progress_store)
 ):
     """批次圖片上傳"""
-    try:
-        # 驗證路徑權限
-        allowed_prefix = api_key_config.get("allowed_prefix", "")
-        if not user_path.startswith(allowed_prefix):
-            raise ImageServiceError(
-                code="PATH_FORBIDDEN", 
-                message="Path access denied",
-                status_code=403,
-                details=f"Path must start with '{allowed_prefix}'"
-            )
-        
-        # 驗證檔案數量
-        if len(files) > MAX_BATCH_SIZE:
+    # 驗證路徑權限
+    validate_user_path(user_path, api_key_config)
+    
+    # 驗證檔案數量
+    if len(files) > MAX_BATCH_SIZE:
+        raise ImageServiceError(
+            code="TOO_MANY_FILES",
+            message="Too many files",
+            status_code=400,
+            details=f"Maximum {MAX_BATCH_SIZE} files allowed"
+        )
+    
+    # 解析並驗證 webhook headers（必須是字串對字串的 JSON 物件）
+    parsed_webhook_headers = None
+    if webhook_headers:
+        try:
+            parsed_webhook_headers = _WEBHOOK_HEADERS_ADAPTER.validate_json(webhook_headers)
+        except ValidationError as e:
             raise ImageServiceError(
-                code="TOO_MANY_FILES",
-                message="Too many files",
+                code="INVALID_WEBHOOK_HEADERS",
+                message="Invalid webhook headers",
                 status_code=400,
-                details=f"Maximum {MAX_BATCH_SIZE} files allowed"
+                details=f"webhook_headers must be a JSON object of string values: {e.errors()[0]['msg']}"
             )
-        
-        # 生成批次 ID
-        batch_id = f"batch-{generate_uuid()}"
-        
-        # 解析 webhook headers
-        parsed_webhook_headers = None
-        if webhook_headers:
-            try:
-                import json
-                parsed_webhook_headers = json.loads(webhook_headers)
-            except json.JSONDecodeError:
-                pass
-        
-        # 初始化批次進度
-        batch_progress[batch_id] = {
-            "total": len(files),
-            "completed": 0,
-            "failed": 0,
-            "status": "processing",
-            "results": [],
-            "start_time": datetime.utcnow().isoformat(),
-            "webhook_url": webhook_url,
-            "webhook_headers": parsed_webhook_headers
-        }
-        
-        # 添加背景任務
-        background_tasks.add_task(
-            process_batch_upload,
-            batch_id, files, user_path, api_key
-        )
-        
-        return BatchUploadResponse(
-            success=True,
-            batch_id=batch_id,
-            status="processing",
-            total_files=len(files),
-            progress_url=f"/api/v1/batch/{batch_id}/progress"
-        )
-        
-    except ImageServiceError as e:
-        from fastapi import HTTPException
-        raise HTTPException(
-            status_code=e.status_code,
-            detail={
-                "error": {
-                    "code": e.code,
-                    "message": e.message,
-                    "details": e.details
-                }
-            }
-        )
+    
+    # 生成批次 ID
+    batch_id = f"batch-{generate_uuid()}"
+    
+    # 初始化批次進度
+    await progress_store.create(batch_id, {
+        "total": len(files),
+        "completed": 0,
+        "failed": 0,
+        "status": "processing",
+        "results": [],
+        "start_time": utc_timestamp(),
+        "start_epoch": time.time(),
+        "webhook_url": webhook_url,
+        "webhook_headers": parsed_webhook_headers
+    })
+    
+    # 添加背景任務
+    background_tasks.add_task(
+        process_batch_upload,
+        batch_id, files, user_path, api_key
+    )
+    
+    return BatchUploadResponse(
+        success=True,
+        batch_id=batch_id,
+        status="processing",
+        total_files=len(files),
+        progress_url=f"/api/v1/batch/{batch_id}/progress"
+    )
 
 @router.get("/batch/{batch_id}/progress", response_model=BatchProgressResponse)
 async def get_batch_progress(
     batch_id: str,
-    api_key: str = Depends(get_api_key)
+    api_key: str = Depends(get_api_key),
+    progress_store = Depends(get_batch_progress_store)
 ):
     """獲取批次上傳進度"""
-    if batch_id not in batch_progress:
-        from fastapi import HTTPException
-        raise HTTPException(
+    progress = await progress_store.get(batch_id)
+    if progress is None:
+        raise http_error(
+            code="BATCH_NOT_FOUND",
+            message="Batch not found",
             status_code=404,
-            detail={
-                "error": {
-                    "code": "BATCH_NOT_FOUND",
-                    "message": "Batch not found",
-                    "details": f"Batch ID {batch_id} does not exist"
-                }
-            }
+            details=f"Batch ID {batch_id} does not exist"
         )
     
-    progress = batch_progress[batch_id]
-    
     # 計算進度百分比
     if progress["total"] > 0:
         progress_percentage = (progress["completed"] + progress["failed"]) / progress["total"] * 100
@@ -222,8 +233,8 @@ async def get_batch_progress(
     # 估算剩餘時間（簡單實作）
     estimated_time = None
     if progress["status"] == "processing" and progress["completed"] > 0:
-        start_time = datetime.fromisoformat(progress["start_time"])
-        elapsed = (datetime.utcnow() - start_time).total_seconds()
+        # 以 epoch 秒數計算經過時間（不需解析時間字串；Redis 後端下建立與查詢可能在不同主機，不能使用單調時鐘）
+        elapsed = time.time() - progress["start_epoch"]
         if elapsed > 0:
             rate = progress["completed"] / elapsed
             remaining = progress["total"] - progress["completed"] - progress["failed"]
@@ -242,20 +253,30 @@ async def get_batch_progress(
         results=progress["results"]
     )
 
+@router.get("/batch/{batch_id}/webhook-failures")
+async def get_batch_webhook_failures(
+    batch_id: str,
+    api_key: str = Depends(get_api_key)
+):
+    """獲取批次重試耗盡仍失敗的 webhook 記錄（只保留在發送通知的程序中）"""
+    return {
+        "batch_id": batch_id,
+        "failures": webhook_service.get_dead_letters(batch_id, api_key)
+    }
+
 async def process_batch_upload(batch_id: str, files: List[UploadFile], 
                              user_path: str, api_key: str):
     """背景處理批次上傳"""
-    import logging
-    logger = logging.getLogger(__name__)
-    
     try:
-        from app.services.webhook import webhook_service
+        storage_service = get_storage_service()
+        progress_store = get_batch_progress_store()
         
-        if batch_id not in batch_progress:
+        progress = await progress_store.get(batch_id)
+        if progress is None:
             logger.error(f"Batch {batch_id} not found in progress tracking")
             return
-            
-        progress = batch_progress[batch_id]
+        
+        total = progress["total"]
         webhook_url = progress.get("webhook_url")
         webhook_headers = progress.get("webhook_headers")
         
@@ -265,74 +286,159 @@ async def process_batch_upload(batch_id: str, files: List[UploadFile],
         logger.error(f"Error in process_batch_upload setup: {e}")
         return
     
-    for i, file in enumerate(files):
-        try:
-            # 讀取檔案內容
-            file_content = await file.read()
-            
-            # 驗證檔案
-            validate_file_content(file_content, file.filename)
-            
-            # 獲取圖片資訊
-            image_info = image_processor.get_image_info(file_content)
-            
-            # 生成 UUID 和檔案名
-            image_uuid = generate_uuid()
-            safe_filename = sanitize_filename(file.filename)
-            file_extension = safe_filename.split('.')[-1] if '.' in safe_filename else 'jpg'
-            storage_filename = f"{image_uuid}.{file_extension}"
-            
-            # 保存檔案
-            relative_file_path = os.path.join(user_path, storage_filename).replace('\\', '/')
-            await storage_service.save_file(file_content, user_path, storage_filename)
-            
-            # 保存元數據
-            storage_service.metadata_manager.add_image(
-                uuid=image_uuid,
-                file_path=relative_file_path,
-                original_name=safe_filename,
-                api_key=api_key,
-                user_path=user_path,
-                file_size=len(file_content),
-                format_type=image_info['format'],
-                dimensions=image_info['dimensions']
+    semaphore = asyncio.Semaphore(BATCH_UPLOAD_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    base_path = user_path.rstrip('/')  # 每批只計算一次
+    
+    # 進度及元數據先暫存於本地，每累積 K 個檔案或每隔一段時間才一次寫入
+    pending_results = []
+    pending_metadata = []
+    pending_reserved = []  # 去重引用既有檔案而保留的 file_path，元數據寫入後釋放
+    flush_lock = asyncio.Lock()
+    last_flush = loop.time()
+    completed = failed = 0
+    
+    # 進度 webhook 由獨立任務發送，發送期間累積的進度合併為下一次通知
+    progress_event = asyncio.Event()
+    uploads_done = False
+    
+    # 預先計算觸發進度 webhook 的處理數（每 10%）及成功數（每 10 張）
+    step = max(1, len(files) // 10)
+    processed_triggers = frozenset(range(step, len(files) + 1, step))
+    completed_triggers = frozenset(range(10, len(files) + 1, 10))
+    
+    async def flush_progress():
+        """將暫存的元數據及檔案結果一次寫入（檔案與元數據先落盤，結果才對外可見）"""
+        nonlocal pending_results, pending_metadata, pending_reserved, last_flush, completed, failed
+        async with flush_lock:
+            if not pending_results:
+                return
+            flushing, pending_results = pending_results, []
+            flushing_metadata, pending_metadata = pending_metadata, []
+            flushing_reserved, pending_reserved = pending_reserved, []
+            last_flush = loop.time()
+            try:
+                # 本次寫入的圖片檔案一起 fsync 後才寫入引用它們的元數據
+                await storage_service.sync_files(list({record["file_path"] for record in flushing_metadata}))
+                await asyncio.to_thread(storage_service.metadata_manager.add_images_bulk, flushing_metadata)
+            except Exception as e:
+                # 元數據寫入失敗時，本次暫存的成功結果一律改記為失敗
+                logger.error(f"Error saving metadata for batch {batch_id}: {e}")
+                moved = sum(1 for _, success in flushing if success)
+                completed -= moved
+                failed += moved
+                flushing = [
+                    ({"filename": result["filename"], "status": "failed", "error": str(e)}, False)
+                    if success else (result, success)
+                    for result, success in flushing
+                ]
+                # 本次新保存的檔案沒有元數據引用，一併移除（去重引用的既有檔案保留，其保留引用於下方釋放）
+                reserved_paths = set(flushing_reserved)
+                await _discard_files(storage_service, [
+                    record["file_path"] for record in flushing_metadata if record["file_path"] not in reserved_paths
+                ])
+            finally:
+                for file_path in flushing_reserved:
+                    storage_service.metadata_manager.release_file(file_path)
+            await progress_store.record_results(
+                batch_id,
+                [result for result, _ in flushing],
+                sum(1 for _, success in flushing if success),
+                sum(1 for _, success in flushing if not success)
             )
-            
-            # 記錄成功結果
-            progress["results"].append({
-                "uuid": image_uuid,
-                "filename": safe_filename,
-                "status": "success"
-            })
-            progress["completed"] += 1
-            
-            # 發送進度 webhook (每完成 10% 或每 10 張圖片)
-            if webhook_url and (
-                (progress["completed"] + progress["failed"]) % max(1, len(files) // 10) == 0 or
-                progress["completed"] % 10 == 0
-            ):
-                progress_data = {
-                    "total": progress["total"],
-                    "completed": progress["completed"],
-                    "failed": progress["failed"],
-                    "progress_percentage": (progress["completed"] + progress["failed"]) / progress["total"] * 100
+    
+    async def upload_one(file: UploadFile):
+        """處理批次中的單一檔案"""
+        nonlocal completed, failed
+        async with semaphore:
+            try:
+                # 只讀取檔案標頭，不將整個檔案載入記憶體
+                header = await file.read(FILE_HEADER_SIZE)
+                file_size = _upload_size(file)
+                
+                # 驗證檔案
+                validate_file_content(header, file.filename, file_size)
+                
+                # 保存檔案，元數據暫存於下次 flush 時批次寫入
+                record, reserved = await _store_upload(file, file_size, user_path, base_path, api_key, storage_service)
+                pending_metadata.append(record)
+                if reserved:
+                    pending_reserved.append(record["file_path"])
+                
+                # 記錄成功結果
+                result = {
+                    "uuid": record["uuid"],
+                    "filename": record["original_name"],
+                    "status": "success"
+                }
+                success = True
+                
+            except Exception as e:
+                # 記錄失敗結果
+                result = {
+                    "filename": file.filename,
+                    "status": "failed",
+                    "error": str(e)
                 }
+                success = False
+        
+        pending_results.append((result, success))
+        if success:
+            completed += 1
+        else:
+            failed += 1
+        # 在任何 await 之前記下本檔案對應的計數，flush 期間其他檔案推進計數也不會跳過觸發點
+        processed, succeeded = completed + failed, completed
+        
+        if (len(pending_results) >= BATCH_PROGRESS_FLUSH_SIZE or
+                loop.time() - last_flush >= BATCH_PROGRESS_FLUSH_INTERVAL):
+            await flush_progress()
+        
+        if not success:
+            return
+        
+        # 通知進度 webhook (每完成 10% 或每 10 張圖片)
+        if webhook_url and (
+            processed in processed_triggers or
+            succeeded in completed_triggers
+        ):
+            progress_event.set()
+    
+    async def emit_progress_webhooks():
+        """等待進度事件並發送進度 webhook"""
+        while True:
+            await progress_event.wait()
+            progress_event.clear()
+            if uploads_done:
+                return
+            
+            progress_data = {
+                "total": total,
+                "completed": completed,
+                "failed": failed,
+                "progress_percentage": (completed + failed) / total * 100
+            }
+            try:
                 await webhook_service.send_batch_progress_webhook(
                     webhook_url, batch_id, "processing", progress_data, api_key, webhook_headers
                 )
-            
-        except Exception as e:
-            # 記錄失敗結果
-            progress["results"].append({
-                "filename": file.filename,
-                "status": "failed",
-                "error": str(e)
-            })
-            progress["failed"] += 1
+            except Exception as e:
+                logger.error(f"Error sending progress webhook: {e}")
+    
+    webhook_task = asyncio.create_task(emit_progress_webhooks()) if webhook_url else None
+    
+    # 以有限並行度同時處理所有檔案
+    await asyncio.gather(*[upload_one(file) for file in files], return_exceptions=True)
+    await flush_progress()
+    
+    if webhook_task is not None:
+        uploads_done = True
+        progress_event.set()
+        await webhook_task
     
     # 更新最終狀態
-    progress["status"] = "completed"
-    progress["end_time"] = datetime.utcnow().isoformat()
+    await progress_store.update(batch_id, status="completed", end_time=utc_timestamp())
+    progress = await progress_store.get(batch_id)
     
     logger.info(f"Batch {batch_id} completed: {progress['completed']} success, {progress['failed']} failed")
     
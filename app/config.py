@@ -5,7 +5,31 @@ from typing import Dict, Any
 STORAGE_PATH = os.getenv("STORAGE_PATH", "./storage")
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", 10 * 1024 * 1024))  # 10MB
 MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 100))
+MAX_IMAGE_DIMENSION = int(os.getenv("MAX_IMAGE_DIMENSION", 20000))  # 單邊最大像素數
+MAX_PIXELS = int(os.getenv("MAX_PIXELS", 89478485))  # 最大總像素數（與 Pillow 的解壓縮炸彈門檻相同）
+UPLOAD_CHUNK_SIZE = 64 * 1024  # 串流寫入區塊大小
+UPLOAD_DEDUP = os.getenv("UPLOAD_DEDUP", "false").lower() == "true"  # 同一 API Key 的重複內容共用同一檔案（選用）
+BATCH_UPLOAD_CONCURRENCY = int(os.getenv("BATCH_UPLOAD_CONCURRENCY", 8))
+BATCH_DELETE_CONCURRENCY = int(os.getenv("BATCH_DELETE_CONCURRENCY", 16))
+
+# CORS 配置
+CORS_ALLOWED_ORIGINS = os.getenv("CORS_ALLOWED_ORIGINS", "*").split(",")
+CORS_MAX_AGE = int(os.getenv("CORS_MAX_AGE", 86400))  # 預檢結果快取時間 (秒)
+
+# 批次進度儲存配置
+BATCH_PROGRESS_BACKEND = os.getenv("BATCH_PROGRESS_BACKEND", "memory")  # memory, redis
+BATCH_PROGRESS_TTL = int(os.getenv("BATCH_PROGRESS_TTL", 24 * 60 * 60))  # seconds
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+BATCH_PROGRESS_FLUSH_SIZE = int(os.getenv("BATCH_PROGRESS_FLUSH_SIZE", 16))  # files
+BATCH_PROGRESS_FLUSH_INTERVAL = float(os.getenv("BATCH_PROGRESS_FLUSH_INTERVAL", 0.5))  # seconds
+METADATA_BACKEND = os.getenv("METADATA_BACKEND", "file")  # file, sqlite
 METADATA_FILE = os.path.join(STORAGE_PATH, "metadata.json")
+METADATA_DB_FILE = os.path.join(STORAGE_PATH, "metadata.db")  # METADATA_BACKEND=sqlite 時使用
+METADATA_LOG_FILE = os.path.join(STORAGE_PATH, "metadata.log")  # 追加寫入的元數據異動日誌
+METADATA_COMPACT_THRESHOLD = int(os.getenv("METADATA_COMPACT_THRESHOLD", 1000))  # log entries
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", 10000))
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", 300))  # seconds
+METADATA_PREFETCH_LIMIT = int(os.getenv("METADATA_PREFETCH_LIMIT", 100))
 
 # API Key 配置
 API_KEYS: Dict[str, Dict[str, Any]] = {
@@ -22,21 +46,32 @@ API_KEYS: Dict[str, Dict[str, Any]] = {
         "allowed_prefix": "test/"
     }
 }
+API_KEY_CACHE_TTL = int(os.getenv("API_KEY_CACHE_TTL", 60))  # seconds
 
 # 支援的圖片格式
-ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "webp"}
-ALLOWED_MIME_TYPES = {
+ALLOWED_EXTENSIONS = frozenset({"jpg", "jpeg", "png", "gif", "webp"})
+ALLOWED_MIME_TYPES = frozenset({
     "image/jpeg", 
     "image/png", 
     "image/gif", 
     "image/webp"
-}
+})
 
 # 圖片處理預設值
 DEFAULT_QUALITY = 85
 DEFAULT_RESIZE_MODE = "fit"  # fit, fill, crop
+DEFAULT_ENCODE_PROFILE = os.getenv("DEFAULT_ENCODE_PROFILE", "balanced")  # fast, balanced, archive
+VARIANT_CACHE_MAX_BYTES = int(os.getenv("VARIANT_CACHE_MAX_BYTES", 256 * 1024 * 1024))  # 256MB
+VARIANT_CACHE_TTL = int(os.getenv("VARIANT_CACHE_TTL", 3600))  # seconds
+VIPS_MIN_FILE_SIZE = int(os.getenv("VIPS_MIN_FILE_SIZE", 2 * 1024 * 1024))  # 2MB，需安裝 pyvips
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 4))  # 圖片處理執行緒數
 
 # Webhook 配置
 WEBHOOK_TIMEOUT = int(os.getenv("WEBHOOK_TIMEOUT", 30))  # seconds
 WEBHOOK_RETRY_ATTEMPTS = int(os.getenv("WEBHOOK_RETRY_ATTEMPTS", 3))
-WEBHOOK_RETRY_DELAY = int(os.getenv("WEBHOOK_RETRY_DELAY", 5))  # seconds
\ No newline at end of file
+WEBHOOK_RETRY_DELAY = int(os.getenv("WEBHOOK_RETRY_DELAY", 5))  # seconds，指數退避的基準
+WEBHOOK_RETRY_MAX_DELAY = int(os.getenv("WEBHOOK_RETRY_MAX_DELAY", 30))  # seconds
+WEBHOOK_DEAD_LETTER_SIZE = int(os.getenv("WEBHOOK_DEAD_LETTER_SIZE", 1000))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 100))
+WEBHOOK_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_KEEPALIVE_CONNECTIONS", 50))
+WEBHOOK_FANOUT_CONCURRENCY = int(os.getenv("WEBHOOK_FANOUT_CONCURRENCY", 32))
\ No newline at end of file
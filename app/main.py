@@ -1,12 +1,14 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import datetime
 import os
 
 from app.api import upload, serve, manage
+from app.services import get_storage_service, get_image_executor
+from app.services.webhook import webhook_service
 from app.utils.security import ImageServiceError
-from app.config import STORAGE_PATH
+from app.utils.timestamps import utc_timestamp
+from app.config import STORAGE_PATH, CORS_ALLOWED_ORIGINS, CORS_MAX_AGE
 
 # 創建 FastAPI 應用
 app = FastAPI(
@@ -14,77 +16,63 @@ app = FastAPI(
     description="A high-performance image storage microservice with authentication and dynamic resizing",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=ORJSONResponse  # 以 orjson 序列化回應，加速大型列表/批次結果
 )
 
 # CORS 中介軟體
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # 在生產環境中應該設定具體的來源
+    allow_origins=CORS_ALLOWED_ORIGINS,  # 在生產環境中應該設定具體的來源
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "DELETE", "OPTIONS"],
+    allow_headers=["Content-Type", "X-API-Key", "If-None-Match"],
+    max_age=CORS_MAX_AGE,
 )
 
 # 全域異常處理器
-@app.exception_handler(ImageServiceError)
-async def image_service_exception_handler(request: Request, exc: ImageServiceError):
-    """處理自定義圖片服務異常"""
-    return JSONResponse(
-        status_code=exc.status_code,
+def _error_response(request: Request, status_code: int, error: dict) -> ORJSONResponse:
+    """建立統一格式的錯誤回應"""
+    return ORJSONResponse(
+        status_code=status_code,
         content={
-            "error": {
-                "code": exc.code,
-                "message": exc.message,
-                "details": exc.details
-            },
-            "timestamp": datetime.utcnow().isoformat(),
-            "path": str(request.url.path)
+            "error": error,
+            "timestamp": utc_timestamp(),
+            "path": request.url.path
         }
     )
 
+@app.exception_handler(ImageServiceError)
+async def image_service_exception_handler(request: Request, exc: ImageServiceError):
+    """處理自定義圖片服務異常"""
+    return _error_response(request, exc.status_code, {
+        "code": exc.code,
+        "message": exc.message,
+        "details": exc.details
+    })
+
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
     """處理 HTTP 異常"""
     # 如果 detail 已經是字典格式（包含錯誤資訊），直接返回
     if isinstance(exc.detail, dict) and "error" in exc.detail:
-        content = exc.detail.copy()
-        content["timestamp"] = datetime.utcnow().isoformat()
-        content["path"] = str(request.url.path)
-        return JSONResponse(
-            status_code=exc.status_code,
-            content=content
-        )
+        return _error_response(request, exc.status_code, exc.detail["error"])
     
     # 否則包裝成標準格式
-    return JSONResponse(
-        status_code=exc.status_code,
-        content={
-            "error": {
-                "code": "HTTP_ERROR",
-                "message": str(exc.detail),
-                "details": None
-            },
-            "timestamp": datetime.utcnow().isoformat(), 
-            "path": str(request.url.path)
-        }
-    )
+    return _error_response(request, exc.status_code, {
+        "code": "HTTP_ERROR",
+        "message": str(exc.detail),
+        "details": None
+    })
 
 @app.exception_handler(500)
 async def internal_server_error_handler(request: Request, exc):
     """處理內部服務器錯誤"""
-    return JSONResponse(
-        status_code=500,
-        content={
-            "error": {
-                "code": "INTERNAL_ERROR",
-                "message": "Internal server error",
-                "details": "An unexpected error occurred"
-            },
-            "timestamp": datetime.utcnow().isoformat(),
-            "path": str(request.url.path)
-        }
-    )
+    return _error_response(request, 500, {
+        "code": "INTERNAL_ERROR",
+        "message": "Internal server error",
+        "details": "An unexpected error occurred"
+    })
 
 # 註冊路由
 app.include_router(upload.router)
@@ -112,16 +100,16 @@ async def health_check():
         
         return {
             "status": "healthy" if storage_accessible else "unhealthy",
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": utc_timestamp(),
             "storage_accessible": storage_accessible,
             "storage_path": STORAGE_PATH
         }
     except Exception as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=503,
             content={
                 "status": "unhealthy",
-                "timestamp": datetime.utcnow().isoformat(),
+                "timestamp": utc_timestamp(),
                 "error": str(e)
             }
         )
@@ -132,6 +120,8 @@ async def startup_event():
     """應用啟動時執行"""
     # 確保儲存目錄存在
     os.makedirs(STORAGE_PATH, exist_ok=True)
+    # 預先建立共用服務實例
+    get_storage_service()
     print(f"Image Storage Microservice started")
     print(f"Storage path: {STORAGE_PATH}")
     print(f"API documentation: http://localhost:8000/docs")
@@ -140,6 +130,8 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     """應用關閉時執行"""
+    get_image_executor().shutdown(wait=False)
+    await webhook_service.close()
     print("Image Storage Microservice shutting down")
 
 if __name__ == "__main__":
@@ -0,0 +1,29 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+from app.config import BATCH_PROGRESS_BACKEND, IMAGE_WORKERS
+from app.services.storage import StorageService
+from app.services.batch_progress import MemoryBatchProgressStore, RedisBatchProgressStore
+
+@lru_cache(maxsize=1)
+def get_storage_service() -> StorageService:
+    """獲取共用的儲存服務實例"""
+    return StorageService()
+
+@lru_cache(maxsize=1)
+def get_image_executor() -> ThreadPoolExecutor:
+    """獲取圖片處理專用的執行緒池（不與預設執行緒池的檔案 I/O 互相搶用）"""
+    return ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+async def run_image_task(func, *args, **kwargs):
+    """在圖片處理執行緒池中執行 CPU 密集的工作"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_image_executor(), partial(func, *args, **kwargs))
+
+@lru_cache(maxsize=1)
+def get_batch_progress_store():
+    """獲取批次進度儲存（依 BATCH_PROGRESS_BACKEND 選擇 memory 或 redis）"""
+    if BATCH_PROGRESS_BACKEND == "redis":
+        return RedisBatchProgressStore()
+    return MemoryBatchProgressStore()
\ No newline at end of file
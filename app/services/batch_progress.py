@@ -0,0 +1,123 @@
+import asyncio
+import orjson
+import time
+from typing import Dict, Any, List, Optional, Tuple
+from app.config import BATCH_PROGRESS_TTL, REDIS_URL
+
+# 內存儲存的分片數
+_SHARD_COUNT = 16
+
+class MemoryBatchProgressStore:
+    """批次進度儲存（單一程序內存，依批次 ID 分片，過期資料自動清除）"""
+    
+    def __init__(self, ttl: int = BATCH_PROGRESS_TTL, shard_count: int = _SHARD_COUNT):
+        self.ttl = ttl
+        # 每個分片：batch_id -> (進度, 過期時間)，並各自擁有一把鎖
+        self._shards: List[Dict[str, Tuple[Dict[str, Any], float]]] = [{} for _ in range(shard_count)]
+        self._locks = [asyncio.Lock() for _ in range(shard_count)]
+    
+    def _shard_index(self, batch_id: str) -> int:
+        return hash(batch_id) % len(self._shards)
+    
+    def _purge_expired(self, shard: Dict[str, Tuple[Dict[str, Any], float]]):
+        """清除分片內過期的批次"""
+        now = time.monotonic()
+        for batch_id in [b for b, (_, expires_at) in shard.items() if expires_at <= now]:
+            del shard[batch_id]
+    
+    async def create(self, batch_id: str, data: Dict[str, Any]):
+        """建立批次進度"""
+        index = self._shard_index(batch_id)
+        progress = dict(data)
+        progress.setdefault("results", [])
+        async with self._locks[index]:
+            shard = self._shards[index]
+            self._purge_expired(shard)
+            shard[batch_id] = (progress, time.monotonic() + self.ttl)
+    
+    async def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """獲取批次進度"""
+        entry = self._shards[self._shard_index(batch_id)].get(batch_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+    
+    async def record_results(self, batch_id: str, results: List[Dict[str, Any]], completed: int, failed: int):
+        """一次記錄多個檔案結果並累加計數"""
+        index = self._shard_index(batch_id)
+        async with self._locks[index]:
+            progress = self._shards[index][batch_id][0]
+            progress["results"].extend(results)
+            progress["completed"] += completed
+            progress["failed"] += failed
+    
+    async def update(self, batch_id: str, **fields):
+        """更新批次欄位"""
+        index = self._shard_index(batch_id)
+        async with self._locks[index]:
+            self._shards[index][batch_id][0].update(fields)
+
+class RedisBatchProgressStore:
+    """批次進度儲存（Redis，跨 worker 共享，以 TTL 自動過期）"""
+    
+    _COUNTERS = ("total", "completed", "failed")
+    
+    def __init__(self, url: str = REDIS_URL, ttl: int = BATCH_PROGRESS_TTL):
+        import redis.asyncio as redis
+        
+        self.ttl = ttl
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+    
+    @staticmethod
+    def _key(batch_id: str) -> str:
+        return f"batch:{batch_id}:progress"
+    
+    @staticmethod
+    def _results_key(batch_id: str) -> str:
+        return f"batch:{batch_id}:results"
+    
+    async def create(self, batch_id: str, data: Dict[str, Any]):
+        """建立批次進度"""
+        fields = {k: orjson.dumps(v) for k, v in data.items() if k != "results"}
+        for counter in self._COUNTERS:
+            fields[counter] = int(data.get(counter, 0))
+        
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(self._results_key(batch_id))
+            pipe.hset(self._key(batch_id), mapping=fields)
+            pipe.expire(self._key(batch_id), self.ttl)
+            await pipe.execute()
+    
+    async def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """獲取批次進度"""
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(self._key(batch_id))
+            pipe.lrange(self._results_key(batch_id), 0, -1)
+            fields, results = await pipe.execute()
+        
+        if not fields:
+            return None
+        
+        progress = {
+            k: int(v) if k in self._COUNTERS else orjson.loads(v)
+            for k, v in fields.items()
+        }
+        progress["results"] = [orjson.loads(r) for r in results]
+        return progress
+    
+    async def record_results(self, batch_id: str, results: List[Dict[str, Any]], completed: int, failed: int):
+        """一次記錄多個檔案結果並原子累加計數（單一 pipeline）"""
+        async with self.client.pipeline(transaction=True) as pipe:
+            if results:
+                pipe.rpush(self._results_key(batch_id), *[orjson.dumps(r) for r in results])
+                pipe.expire(self._results_key(batch_id), self.ttl)
+            pipe.hincrby(self._key(batch_id), "completed", completed)
+            pipe.hincrby(self._key(batch_id), "failed", failed)
+            await pipe.execute()
+    
+    async def update(self, batch_id: str, **fields):
+        """更新批次欄位"""
+        await self.client.hset(
+            self._key(batch_id),
+            mapping={k: orjson.dumps(v) for k, v in fields.items()}
+        )
\ No newline at end of file
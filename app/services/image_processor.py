@@ -1,140 +1,335 @@
 from PIL import Image, ImageOps
+from contextlib import nullcontext
 import io
-from typing import Dict, Optional, Tuple
-from app.config import DEFAULT_QUALITY, DEFAULT_RESIZE_MODE
+import logging
+import os
+import struct
+from typing import Any, BinaryIO, Dict, Optional, Tuple, Union
+from app.config import (
+    DEFAULT_QUALITY, DEFAULT_RESIZE_MODE, DEFAULT_ENCODE_PROFILE, VIPS_MIN_FILE_SIZE, MAX_IMAGE_DIMENSION, MAX_PIXELS
+)
 from app.utils.security import ImageServiceError
 
-class ImageProcessor:
-    """圖片處理服務"""
+logger = logging.getLogger(__name__)
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    # libvips 為選用依賴，未安裝時全部使用 Pillow
+    pyvips = None
+
+# libvips 載入器對應的格式，以及 libvips 路徑支援的輸出格式
+_VIPS_LOADER_FORMATS = {
+    'jpegload': 'jpeg',
+    'jpegload_buffer': 'jpeg',
+    'pngload': 'png',
+    'pngload_buffer': 'png',
+    'webpload': 'webp',
+    'webpload_buffer': 'webp'
+}
+_VIPS_OUTPUT_FORMATS = frozenset({'jpg', 'jpeg', 'png', 'webp'})
+
+# 編碼設定檔：optimize 為 JPEG/PNG 額外的最佳化編碼（較慢、檔案略小），webp_method 為 WebP 壓縮方法（0 最快，6 最慢）
+ENCODE_PROFILES = {
+    "fast": {"optimize": False, "webp_method": 2},
+    "balanced": {"optimize": False, "webp_method": 4},
+    "archive": {"optimize": True, "webp_method": 6}
+}
+
+# JPEG 中帶有尺寸的 SOF 標記（排除 DHT/JPG/DAC）
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# JPEG 中沒有長度欄位的獨立標記
+_JPEG_STANDALONE_MARKERS = frozenset(range(0xD0, 0xDA)) | {0x01}
+# 掃描 JPEG 標記時最多讀取的位元組數
+_JPEG_SCAN_LIMIT = 512 * 1024
+
+def _sniff_jpeg(source: BinaryIO) -> Optional[Tuple[int, int]]:
+    """走訪 JPEG 標記直到 SOF，返回 (寬, 高)"""
+    source.seek(2)
+    while source.tell() < _JPEG_SCAN_LIMIT:
+        byte = source.read(1)
+        if byte != b'\xff':
+            return None
+        marker = source.read(1)
+        while marker == b'\xff':
+            marker = source.read(1)
+        if not marker:
+            return None
+        
+        marker = marker[0]
+        if marker in _JPEG_STANDALONE_MARKERS:
+            continue
+        
+        segment = source.read(2)
+        if len(segment) < 2:
+            return None
+        length = struct.unpack('>H', segment)[0]
+        if marker in _JPEG_SOF_MARKERS:
+            frame = source.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return width, height
+        source.seek(length - 2, io.SEEK_CUR)
+    return None
+
+def _sniff_header(source: BinaryIO) -> Optional[Tuple[str, int, int]]:
+    """只解析檔案標頭取得 (格式, 寬, 高)，無法辨識時返回 None"""
+    source.seek(0)
+    head = source.read(30)
     
-    @staticmethod
-    def get_image_info(file_content: bytes) -> Dict[str, any]:
-        """獲取圖片資訊"""
-        try:
-            with Image.open(io.BytesIO(file_content)) as img:
-                return {
-                    "format": img.format,
-                    "dimensions": {"width": img.width, "height": img.height},
-                    "mode": img.mode
-                }
-        except Exception as e:
-            raise ImageServiceError(
-                code="IMAGE_PROCESSING_ERROR",
-                message="Failed to process image",
-                status_code=400,
-                details=f"Cannot read image: {str(e)}"
-            )
+    if head[:2] == b'\xff\xd8':
+        size = _sniff_jpeg(source)
+        return ('JPEG', *size) if size else None
     
-    @staticmethod
-    def resize_image(file_content: bytes, width: Optional[int] = None, 
-                    height: Optional[int] = None, quality: int = DEFAULT_QUALITY,
-                    output_format: Optional[str] = None, 
-                    mode: str = DEFAULT_RESIZE_MODE) -> Tuple[bytes, str]:
-        """調整圖片大小"""
-        try:
-            with Image.open(io.BytesIO(file_content)) as img:
-                original_format = img.format.lower() if img.format else 'jpeg'
-                target_format = output_format.lower() if output_format else original_format
-                
-                # 確保 RGB 模式（避免調色盤模式的問題）
-                if img.mode in ('RGBA', 'LA'):
-                    # 保持透明度
-                    if target_format in ['jpg', 'jpeg']:
-                        # JPEG 不支援透明度，轉換為白色背景
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        if img.mode == 'RGBA':
-                            background.paste(img, mask=img.split()[-1])
-                        img = background
-                elif img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                # 如果沒有指定尺寸，返回原圖
-                if width is None and height is None:
-                    output_buffer = io.BytesIO()
-                    save_format = 'JPEG' if target_format in ['jpg', 'jpeg'] else target_format.upper()
-                    
-                    save_kwargs = {'format': save_format}
-                    if save_format == 'JPEG':
-                        save_kwargs['quality'] = quality
-                        save_kwargs['optimize'] = True
-                    
-                    img.save(output_buffer, **save_kwargs)
-                    return output_buffer.getvalue(), target_format
-                
-                # 計算目標尺寸
-                original_width, original_height = img.size
-                
-                if width and height:
-                    target_size = (width, height)
-                elif width:
-                    # 按寬度等比縮放
-                    ratio = width / original_width
-                    target_size = (width, int(original_height * ratio))
-                else:
-                    # 按高度等比縮放
-                    ratio = height / original_height
-                    target_size = (int(original_width * ratio), height)
-                
-                # 根據模式調整圖片
-                if mode == 'fit':
-                    # 保持比例，完整顯示圖片
-                    img.thumbnail(target_size, Image.Resampling.LANCZOS)
-                elif mode == 'fill':
-                    # 填滿目標尺寸，可能會拉伸
-                    img = img.resize(target_size, Image.Resampling.LANCZOS)
-                elif mode == 'crop':
-                    # 裁切並填滿目標尺寸
-                    img = ImageOps.fit(img, target_size, Image.Resampling.LANCZOS)
-                else:
-                    # 預設使用 fit 模式
-                    img.thumbnail(target_size, Image.Resampling.LANCZOS)
-                
-                # 保存到緩衝區
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR' and len(head) >= 24:
+        width, height = struct.unpack('>II', head[16:24])
+        return 'PNG', width, height
+    
+    if head[:6] in (b'GIF87a', b'GIF89a') and len(head) >= 10:
+        width, height = struct.unpack('<HH', head[6:10])
+        return 'GIF', width, height
+    
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP' and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+            width, height = struct.unpack('<HH', head[26:30])
+            return 'WEBP', width & 0x3FFF, height & 0x3FFF
+        if chunk == b'VP8L' and head[20] == 0x2F:
+            bits = struct.unpack('<I', head[21:25])[0]
+            return 'WEBP', (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b'VP8X':
+            width = int.from_bytes(head[24:27], 'little') + 1
+            height = int.from_bytes(head[27:30], 'little') + 1
+            return 'WEBP', width, height
+    return None
+
+def _target_size(original_width: int, original_height: int,
+                 width: Optional[int], height: Optional[int]) -> Tuple[int, int]:
+    """計算目標尺寸（只指定寬或高時等比縮放）"""
+    if width and height:
+        return width, height
+    if width:
+        # 按寬度等比縮放
+        return width, int(original_height * width / original_width)
+    # 按高度等比縮放
+    return int(original_width * height / original_height), height
+
+def _resize_with_vips(file_content: Union[bytes, str], width: Optional[int], height: Optional[int],
+                      quality: int, output_format: Optional[str], mode: str,
+                      encode_profile: Dict[str, Any]) -> Optional[Tuple[bytes, str]]:
+    """以 libvips 串流管線縮放大圖（可傳入位元組或路徑），不支援的格式或處理失敗時返回 None（改用 Pillow）"""
+    try:
+        from_file = isinstance(file_content, str)
+        if from_file:
+            source = pyvips.Image.new_from_file(file_content)
+        else:
+            source = pyvips.Image.new_from_buffer(file_content, "")
+        thumbnail = pyvips.Image.thumbnail if from_file else pyvips.Image.thumbnail_buffer
+        original_format = _VIPS_LOADER_FORMATS.get(source.get('vips-loader'))
+        target_format = output_format.lower() if output_format else original_format
+        if original_format is None or target_format not in _VIPS_OUTPUT_FORMATS:
+            return None
+        
+        target_width, target_height = _target_size(source.width, source.height, width, height)
+        if mode == 'fill':
+            img = thumbnail(file_content, target_width, height=target_height, size='force')
+        elif mode == 'crop':
+            img = thumbnail(file_content, target_width, height=target_height, crop='centre')
+        else:
+            # fit：保持比例且只縮小，與 Pillow 的 thumbnail 相同
+            img = thumbnail(file_content, target_width, height=target_height, size='down')
+        
+        if target_format in ('jpg', 'jpeg'):
+            # JPEG 不支援透明度，轉換為白色背景
+            if img.hasalpha():
+                img = img.flatten(background=[255, 255, 255])
+            return img.write_to_buffer(
+                '.jpg', Q=quality, optimize_coding=encode_profile["optimize"], strip=True
+            ), target_format
+        if target_format == 'webp':
+            return img.write_to_buffer(
+                '.webp', Q=quality, effort=encode_profile["webp_method"], strip=True
+            ), target_format
+        return img.write_to_buffer('.png', strip=True), target_format
+    except pyvips.Error:
+        return None
+
+def open_image(source: Union[bytes, BinaryIO, str]) -> Image.Image:
+    """開啟圖片（可傳入位元組、檔案物件或路徑），可搭配 with 使用"""
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    return Image.open(source)
+
+def info_from_image(img: Image.Image) -> Dict[str, any]:
+    """從已開啟的圖片獲取資訊（只讀取標頭，不解碼像素）"""
+    return {
+        "format": img.format,
+        "dimensions": {"width": img.width, "height": img.height},
+        "mode": img.mode
+    }
+
+def get_image_info(file_content: Union[bytes, BinaryIO]) -> Dict[str, any]:
+    """獲取圖片資訊（可傳入位元組或檔案物件）"""
+    try:
+        with open_image(file_content) as img:
+            return info_from_image(img)
+    except Exception as e:
+        raise ImageServiceError(
+            code="IMAGE_PROCESSING_ERROR",
+            message="Failed to process image",
+            status_code=400,
+            details=f"Cannot read image: {str(e)}"
+        )
+
+def _check_dimensions(width: int, height: int):
+    """拒絕為 0 或超過上限的尺寸（標頭可能被截斷或竄改）"""
+    if (width <= 0 or height <= 0 or width > MAX_IMAGE_DIMENSION or height > MAX_IMAGE_DIMENSION
+            or width * height > MAX_PIXELS):
+        raise ImageServiceError(
+            code="INVALID_IMAGE_DIMENSIONS",
+            message="Invalid image dimensions",
+            status_code=400,
+            details=f"Image is {width}x{height}; each side must be 1-{MAX_IMAGE_DIMENSION} and at most {MAX_PIXELS} pixels in total"
+        )
+
+def probe_image_info(source: BinaryIO) -> Dict[str, any]:
+    """以 PIL 延遲開啟確認格式（只讀標頭，不解碼像素），尺寸優先取自標頭解析並檢查範圍"""
+    try:
+        sniffed = _sniff_header(source)
+    except (OSError, struct.error):
+        sniffed = None
+    
+    source.seek(0)
+    info = get_image_info(source)
+    dimensions = info["dimensions"]
+    if sniffed is not None and sniffed[0] == info["format"]:
+        dimensions = {"width": sniffed[1], "height": sniffed[2]}
+    _check_dimensions(**dimensions)
+    return {
+        "format": info["format"],
+        "dimensions": dimensions
+    }
+
+def _source_size(file_content: Union[bytes, str]) -> int:
+    """獲取位元組內容或檔案路徑的大小"""
+    if isinstance(file_content, str):
+        return os.path.getsize(file_content)
+    return len(file_content)
+
+def resize_image(file_content: Union[bytes, BinaryIO, str, Image.Image], width: Optional[int] = None, 
+                height: Optional[int] = None, quality: int = DEFAULT_QUALITY,
+                output_format: Optional[str] = None, 
+                mode: str = DEFAULT_RESIZE_MODE,
+                profile: str = DEFAULT_ENCODE_PROFILE) -> Tuple[bytes, str]:
+    """調整圖片大小（可傳入位元組、檔案物件、路徑或已開啟的圖片，已開啟的圖片由呼叫端關閉）"""
+    encode_profile = ENCODE_PROFILES.get(profile, ENCODE_PROFILES[DEFAULT_ENCODE_PROFILE])
+    
+    # 大圖改用 libvips（已安裝時），其串流管線較快且佔用記憶體較少
+    if (pyvips is not None and isinstance(file_content, (bytes, str)) and (width or height)
+            and _source_size(file_content) >= VIPS_MIN_FILE_SIZE):
+        resized = _resize_with_vips(file_content, width, height, quality, output_format, mode, encode_profile)
+        if resized is not None:
+            return resized
+    
+    try:
+        if isinstance(file_content, Image.Image):
+            opened = nullcontext(file_content)
+        else:
+            opened = open_image(file_content)
+        with opened as img:
+            original_format = img.format.lower() if img.format else 'jpeg'
+            target_format = output_format.lower() if output_format else original_format
+            
+            # 確保 RGB 模式（避免調色盤模式的問題）
+            if img.mode in ('RGBA', 'LA'):
+                # 保持透明度
+                if target_format in ['jpg', 'jpeg']:
+                    # JPEG 不支援透明度，轉換為白色背景
+                    background = Image.new('RGB', img.size, (255, 255, 255))
+                    if img.mode == 'RGBA':
+                        background.paste(img, mask=img.split()[-1])
+                    img = background
+            elif img.mode != 'RGB':
+                img = img.convert('RGB')
+            
+            # 如果沒有指定尺寸，返回原圖
+            if width is None and height is None:
                 output_buffer = io.BytesIO()
                 save_format = 'JPEG' if target_format in ['jpg', 'jpeg'] else target_format.upper()
                 
                 save_kwargs = {'format': save_format}
                 if save_format == 'JPEG':
                     save_kwargs['quality'] = quality
-                    save_kwargs['optimize'] = True
-                elif save_format == 'PNG':
-                    save_kwargs['optimize'] = True
-                elif save_format == 'WEBP':
-                    save_kwargs['quality'] = quality
-                    save_kwargs['method'] = 6  # 高品質壓縮
+                    save_kwargs['optimize'] = encode_profile['optimize']
                 
                 img.save(output_buffer, **save_kwargs)
                 return output_buffer.getvalue(), target_format
-                
-        except Exception as e:
-            raise ImageServiceError(
-                code="IMAGE_PROCESSING_ERROR",
-                message="Failed to resize image",
-                status_code=500,
-                details=str(e)
-            )
+            
+            # 計算目標尺寸
+            target_size = _target_size(*img.size, width, height)
+            
+            # 根據模式調整圖片
+            if mode == 'fit':
+                # 保持比例，完整顯示圖片
+                img.thumbnail(target_size, Image.Resampling.LANCZOS)
+            elif mode == 'fill':
+                # 填滿目標尺寸，可能會拉伸
+                img = img.resize(target_size, Image.Resampling.LANCZOS)
+            elif mode == 'crop':
+                # 裁切並填滿目標尺寸
+                img = ImageOps.fit(img, target_size, Image.Resampling.LANCZOS)
+            else:
+                # 預設使用 fit 模式
+                img.thumbnail(target_size, Image.Resampling.LANCZOS)
+            
+            # 保存到緩衝區
+            output_buffer = io.BytesIO()
+            save_format = 'JPEG' if target_format in ['jpg', 'jpeg'] else target_format.upper()
+            
+            save_kwargs = {'format': save_format}
+            if save_format == 'JPEG':
+                save_kwargs['quality'] = quality
+                save_kwargs['optimize'] = encode_profile['optimize']
+            elif save_format == 'PNG':
+                save_kwargs['optimize'] = encode_profile['optimize']
+            elif save_format == 'WEBP':
+                save_kwargs['quality'] = quality
+                save_kwargs['method'] = encode_profile['webp_method']
+            
+            img.save(output_buffer, **save_kwargs)
+            return output_buffer.getvalue(), target_format
+            
+    except Exception as e:
+        # 例外訊息可能含有儲存路徑，只寫入伺服器日誌，不回傳給用戶端
+        logger.error(f"Failed to resize image: {e}")
+        raise ImageServiceError(
+            code="IMAGE_PROCESSING_ERROR",
+            message="Failed to resize image",
+            status_code=500,
+            details="Failed to process image"
+        )
+
+def validate_and_convert_format(format_str: Optional[str]) -> Optional[str]:
+    """驗證並轉換圖片格式"""
+    if not format_str:
+        return None
     
-    @staticmethod
-    def validate_and_convert_format(format_str: Optional[str]) -> Optional[str]:
-        """驗證並轉換圖片格式"""
-        if not format_str:
-            return None
-        
-        format_mapping = {
-            'jpg': 'jpeg',
-            'jpeg': 'jpeg', 
-            'png': 'png',
-            'webp': 'webp',
-            'gif': 'gif'
-        }
-        
-        format_lower = format_str.lower()
-        if format_lower not in format_mapping:
-            raise ImageServiceError(
-                code="INVALID_FORMAT",
-                message="Invalid output format",
-                status_code=400,
-                details=f"Supported formats: {', '.join(format_mapping.keys())}"
-            )
-        
-        return format_mapping[format_lower]
\ No newline at end of file
+    format_mapping = {
+        'jpg': 'jpeg',
+        'jpeg': 'jpeg', 
+        'png': 'png',
+        'webp': 'webp',
+        'gif': 'gif'
+    }
+    
+    format_lower = format_str.lower()
+    if format_lower not in format_mapping:
+        raise ImageServiceError(
+            code="INVALID_FORMAT",
+            message="Invalid output format",
+            status_code=400,
+            details=f"Supported formats: {', '.join(format_mapping.keys())}"
+        )
+    
+    return format_mapping[format_lower]
\ No newline at end of file
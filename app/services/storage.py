@@ -1,17 +1,55 @@
 import os
-import json
-import aiofiles
-from typing import Dict, Any, Optional, List
+import shutil
+import asyncio
+import bisect
+import hashlib
+import logging
+import sqlite3
+import orjson
+import threading
+from cachetools import TTLCache
+from typing import BinaryIO, Dict, Any, Optional, List, Set, Tuple
 from datetime import datetime
-from app.config import STORAGE_PATH, METADATA_FILE
+from app.config import (
+    STORAGE_PATH, METADATA_BACKEND, METADATA_FILE, METADATA_LOG_FILE, METADATA_DB_FILE,
+    METADATA_COMPACT_THRESHOLD, METADATA_CACHE_SIZE, METADATA_CACHE_TTL, METADATA_PREFETCH_LIMIT, UPLOAD_CHUNK_SIZE
+)
 from app.utils.security import ImageServiceError
 
+logger = logging.getLogger(__name__)
+
+# 並非所有平台都提供 posix_fadvise（例如 macOS、Windows）
+_HAS_FADVISE = hasattr(os, "posix_fadvise")
+
+# SQLite 後端：IN 查詢每段的參數數量，以及前綴範圍查詢的上界字元
+_SQLITE_MAX_PARAMS = 500
+_MAX_CHAR = chr(0x10FFFF)
+
 class MetadataManager:
     """管理圖片元數據"""
     
     def __init__(self):
         self.metadata_file = METADATA_FILE
+        # 異動只追加到日誌，累積一定筆數後再合併成 metadata.json 快照
+        self.log_file = METADATA_LOG_FILE
+        self._log_entries = 0
+        # 記憶體中的元數據為主要資料來源，寫入時同步保存到檔案；以檔案 mtime 偵測其他程序的修改
+        self._lock = threading.RLock()
+        self._metadata: Dict[str, Any] = {}
+        self._metadata_version: Tuple[Optional[int], Optional[int]] = (None, None)
+        # 本程序正在寫入日誌的執行緒數（寫入可在工作執行緒中進行，期間檔案版本與記憶體暫時不一致）
+        self._writing = 0
+        # 熱門圖片的元數據快取（權限由元數據中的 api_key 直接判斷）
+        self._image_cache = TTLCache(maxsize=METADATA_CACHE_SIZE, ttl=METADATA_CACHE_TTL)
+        # 內容去重索引：(api_key, content_hash) -> 代表元數據，以及 file_path -> 引用數（首次使用時建立）
+        self._content_index: Optional[Dict[Tuple[str, str], Dict[str, Any]]] = None
+        self._file_refs: Dict[str, int] = {}
+        # 列表索引：api_key -> 依 (upload_time, uuid) 排序的列表，與去重索引一同建立
+        self._key_index: Dict[str, List[Tuple[str, str]]] = {}
+        # 去重上傳已引用、但元數據尚未寫入的檔案：file_path -> 保留數（只存在於本程序，重新載入時不清除）
+        self._reserved_refs: Dict[str, int] = {}
         self._ensure_storage_structure()
+        self._reload_metadata(repair=True)
     
     def _ensure_storage_structure(self):
         """確保儲存目錄和元數據檔案存在"""
@@ -19,26 +57,135 @@ class MetadataManager:
         if not os.path.exists(self.metadata_file):
             self._save_metadata({})
     
-    def _load_metadata(self) -> Dict[str, Any]:
-        """載入元數據"""
+    @staticmethod
+    def _file_mtime(path: str) -> Optional[int]:
+        """獲取檔案的修改時間（檔案不存在時返回 None）"""
         try:
-            with open(self.metadata_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+    
+    def _current_version(self) -> Tuple[Optional[int], Optional[int]]:
+        """以快照及日誌的修改時間作為元數據版本"""
+        return self._file_mtime(self.metadata_file), self._file_mtime(self.log_file)
+    
+    def _read_metadata_file(self) -> Dict[str, Any]:
+        """從快照讀取並解析元數據"""
+        try:
+            with open(self.metadata_file, 'rb') as f:
+                return orjson.loads(f.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
             return {}
     
+    def _replay_log(self, metadata: Dict[str, Any], repair: bool = False) -> int:
+        """將日誌中的異動依序套用到元數據，返回日誌筆數（repair 時截掉寫入中斷留下的不完整尾端）"""
+        try:
+            with open(self.log_file, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        
+        # 沒有換行的尾端可能是其他程序正在追加的內容，平時只略過；只有啟動時才視為寫入中斷並截掉
+        complete = data.rfind(b"\n") + 1
+        if repair and complete < len(data):
+            os.truncate(self.log_file, complete)
+        
+        entries = 0
+        for line in data[:complete].splitlines():
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            if entry["op"] == "add":
+                metadata[entry["uuid"]] = entry["data"]
+            else:
+                metadata.pop(entry["uuid"], None)
+            entries += 1
+        return entries
+    
+    def _reload_metadata(self, repair: bool = False):
+        """重新載入元數據，並清除由舊資料衍生的快取及索引"""
+        with self._lock:
+            self._metadata_version = self._current_version()
+            self._metadata = self._read_metadata_file()
+            self._log_entries = self._replay_log(self._metadata, repair)
+            self._image_cache.clear()
+            self._content_index = None
+            self._file_refs = {}
+            self._key_index = {}
+    
+    def _load_metadata(self) -> Dict[str, Any]:
+        """獲取記憶體中的元數據（檔案被其他程序修改過時才重新解析）"""
+        # 本程序寫入中時記憶體中的資料即為最新，不必因檔案版本變動而重新載入
+        if not self._writing and self._current_version() != self._metadata_version:
+            self._reload_metadata()
+        return self._metadata
+    
     def _save_metadata(self, metadata: Dict[str, Any]):
-        """保存元數據"""
-        with open(self.metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False, default=str)
+        """保存元數據快照（先寫入暫存檔再替換，避免寫入中斷留下不完整的檔案）"""
+        temp_file = f"{self.metadata_file}.tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
+            # 壓縮時替換後會清空日誌，快照內容必須先落盤
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.metadata_file)
+        self._fsync_directory()
+        self._metadata_version = self._current_version()
     
-    def add_image(self, uuid: str, file_path: str, original_name: str, 
-                  api_key: str, user_path: str, file_size: int, 
-                  format_type: str, dimensions: Dict[str, int]) -> Dict[str, Any]:
-        """添加圖片元數據"""
-        metadata = self._load_metadata()
-        
-        image_data = {
+    def _fsync_directory(self):
+        """將元數據所在目錄落盤，確保替換後的檔名在當機後仍然有效（僅 POSIX 支援）"""
+        if os.name != "posix":
+            return
+        fd = os.open(os.path.dirname(self.metadata_file) or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    
+    def _append_log(self, entries: List[Dict[str, Any]]):
+        """將異動追加到日誌，累積到門檻時合併成快照（呼叫端需持有 self._lock）"""
+        self._writing += 1
+        try:
+            self._write_log(entries)
+        finally:
+            self._writing -= 1
+    
+    def _write_log(self, entries: List[Dict[str, Any]]):
+        """寫入並落盤日誌，累積到門檻時合併成快照"""
+        with open(self.log_file, 'ab+') as f:
+            # 日誌尾端若是寫入中斷留下的不完整內容，先補上換行，避免新內容與其黏在同一行
+            prefix = b""
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    prefix = b"\n"
+            f.write(prefix + b"".join(orjson.dumps(entry) + b"\n" for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_entries += len(entries)
+        if self._log_entries >= METADATA_COMPACT_THRESHOLD:
+            # 異動已寫入日誌，合併失敗不影響這次寫入，下次寫入時再試
+            try:
+                self._compact()
+            except OSError as e:
+                logger.error(f"Failed to compact metadata log: {e}")
+        self._metadata_version = self._current_version()
+    
+    def _compact(self):
+        """將記憶體中的元數據寫成新快照並清空日誌（重播舊日誌的結果相同，中途中斷也不會遺失資料）"""
+        with self._lock:
+            self._save_metadata(self._metadata)
+            open(self.log_file, 'wb').close()
+            self._log_entries = 0
+            self._metadata_version = self._current_version()
+    
+    @staticmethod
+    def _build_record(file_path: str, original_name: str, api_key: str, user_path: str,
+                      file_size: int, format_type: str, dimensions: Dict[str, int],
+                      content_hash: Optional[str] = None) -> Dict[str, Any]:
+        """建立單張圖片的元數據（每筆各自記錄上傳時間，列表依此排序）"""
+        record = {
             "file_path": file_path,
             "original_name": original_name,
             "api_key": api_key,
@@ -48,74 +195,516 @@ class MetadataManager:
             "dimensions": dimensions,
             "upload_time": datetime.utcnow().isoformat()
         }
+        if content_hash:
+            record["content_hash"] = content_hash
+        return record
+    
+    def _ensure_indexes(self, metadata: Optional[Dict[str, Any]] = None):
+        """首次使用時由元數據建立去重索引、檔案引用數及列表索引"""
+        if self._content_index is not None:
+            return
+        # 寫入可能在工作執行緒中進行，建立索引期間需持有鎖
+        with self._lock:
+            if self._content_index is not None:
+                return
+            if metadata is None:
+                metadata = self._load_metadata()
+            # 先在區域變數中建立，完成後才設定，未持有鎖的查詢不會看到建立到一半的引用數
+            content_index, file_refs, key_index = {}, {}, {}
+            for uuid, image_data in metadata.items():
+                key_index.setdefault(image_data.get("api_key"), []).append(
+                    (image_data.get("upload_time", ""), uuid)
+                )
+                self._index_content(image_data, content_index, file_refs)
+            # 全部加入後每個列表只排序一次，不必逐筆 insort
+            for entries in key_index.values():
+                entries.sort()
+            self._file_refs = file_refs
+            self._key_index = key_index
+            self._content_index = content_index
+    
+    def _index_record(self, uuid: str, image_data: Dict[str, Any]):
+        """將一筆元數據加入各索引並增加檔案引用數"""
+        bisect.insort(
+            self._key_index.setdefault(image_data.get("api_key"), []),
+            (image_data.get("upload_time", ""), uuid)
+        )
+        self._index_content(image_data, self._content_index, self._file_refs)
+    
+    @staticmethod
+    def _index_content(image_data: Dict[str, Any], content_index: Dict[Tuple[str, str], Dict[str, Any]],
+                       file_refs: Dict[str, int]):
+        """將一筆元數據加入去重索引並增加檔案引用數"""
+        file_path = image_data["file_path"]
+        file_refs[file_path] = file_refs.get(file_path, 0) + 1
+        content_hash = image_data.get("content_hash")
+        if content_hash:
+            content_index.setdefault((image_data["api_key"], content_hash), image_data)
+    
+    def _unindex_record(self, uuid: str, image_data: Dict[str, Any]):
+        """從列表索引移除並減少檔案引用數，沒有任何引用時從去重索引移除"""
+        entries = self._key_index.get(image_data.get("api_key"), [])
+        entry = (image_data.get("upload_time", ""), uuid)
+        position = bisect.bisect_left(entries, entry)
+        if position < len(entries) and entries[position] == entry:
+            del entries[position]
         
-        metadata[uuid] = image_data
-        self._save_metadata(metadata)
-        return image_data
+        file_path = image_data["file_path"]
+        refs = self._file_refs.get(file_path, 0) - 1
+        if refs > 0:
+            self._file_refs[file_path] = refs
+            return
+        self._file_refs.pop(file_path, None)
+        key = (image_data["api_key"], image_data.get("content_hash"))
+        indexed = self._content_index.get(key)
+        if indexed is not None and indexed["file_path"] == file_path:
+            del self._content_index[key]
+    
+    def get_by_hash(self, api_key: str, content_hash: str) -> Optional[Dict[str, Any]]:
+        """以內容雜湊查詢同一 API Key 已上傳的相同圖片"""
+        self._ensure_indexes()
+        return self._content_index.get((api_key, content_hash))
+    
+    def file_ref_count(self, file_path: str) -> int:
+        """獲取實體檔案目前被多少筆元數據（含尚未寫入的保留引用）引用"""
+        self._ensure_indexes()
+        return self._file_refs.get(file_path, 0) + self._reserved_refs.get(file_path, 0)
+    
+    def reserve_file(self, file_path: str):
+        """保留檔案引用，直到引用它的元數據寫入為止（期間刪除其他元數據不會移除此檔案）"""
+        self._reserved_refs[file_path] = self._reserved_refs.get(file_path, 0) + 1
+    
+    def release_file(self, file_path: str):
+        """釋放 reserve_file 保留的檔案引用（元數據寫入後或寫入失敗時呼叫）"""
+        refs = self._reserved_refs.get(file_path, 0) - 1
+        if refs > 0:
+            self._reserved_refs[file_path] = refs
+        else:
+            self._reserved_refs.pop(file_path, None)
+    
+    def add_image(self, uuid: str, file_path: str, original_name: str, 
+                  api_key: str, user_path: str, file_size: int, 
+                  format_type: str, dimensions: Dict[str, int],
+                  content_hash: Optional[str] = None) -> Dict[str, Any]:
+        """添加圖片元數據"""
+        return self.add_images_bulk([{
+            "uuid": uuid,
+            "file_path": file_path,
+            "original_name": original_name,
+            "api_key": api_key,
+            "user_path": user_path,
+            "file_size": file_size,
+            "format_type": format_type,
+            "dimensions": dimensions,
+            "content_hash": content_hash
+        }])[uuid]
+    
+    def add_images_bulk(self, records: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """批次添加圖片元數據（只追加寫入一次日誌），records 的欄位同 add_image 參數"""
+        if not records:
+            return {}
+        
+        with self._lock:
+            metadata = self._load_metadata()
+            self._ensure_indexes(metadata)
+            added = {}
+            for record in records:
+                record = dict(record)
+                uuid = record.pop("uuid")
+                added[uuid] = metadata[uuid] = self._build_record(**record)
+            try:
+                self._append_log([
+                    {"op": "add", "uuid": uuid, "data": image_data} for uuid, image_data in added.items()
+                ])
+            except Exception:
+                # 日誌未能寫入時還原記憶體中的元數據，呼叫端才能安全移除這些圖片的檔案
+                for uuid in added:
+                    metadata.pop(uuid, None)
+                raise
+            
+            for uuid, image_data in added.items():
+                self._index_record(uuid, image_data)
+        
+        for uuid, image_data in added.items():
+            self.invalidate(uuid)
+            self._image_cache[uuid] = image_data
+        return added
     
     def get_image(self, uuid: str) -> Optional[Dict[str, Any]]:
         """獲取圖片元數據"""
+        image_data = self._image_cache.get(uuid)
+        if image_data is not None:
+            return image_data
+        
         metadata = self._load_metadata()
-        return metadata.get(uuid)
+        image_data = metadata.get(uuid)
+        if image_data is not None:
+            self._image_cache[uuid] = image_data
+            self._prefetch_neighbours(metadata, uuid, image_data)
+        return image_data
+    
+    def _prefetch_neighbours(self, metadata: Dict[str, Any], uuid: str, image_data: Dict[str, Any]):
+        """預先載入列表中前後相鄰圖片的元數據（用戶端通常依列表順序接續存取）"""
+        self._ensure_indexes(metadata)
+        entries = self._key_index.get(image_data.get("api_key"), [])
+        position = bisect.bisect_left(entries, (image_data.get("upload_time", ""), uuid))
+        half = METADATA_PREFETCH_LIMIT // 2
+        for _, neighbour_uuid in entries[max(position - half, 0):position + half + 1]:
+            if neighbour_uuid not in self._image_cache:
+                self._image_cache[neighbour_uuid] = metadata[neighbour_uuid]
+    
+    def get_image_if_permitted(self, uuid: str, api_key: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """一次查詢獲取圖片元數據及權限，返回 (元數據或 None, 是否有權限)"""
+        image_data = self.get_image(uuid)
+        if image_data is None:
+            return None, False
+        return image_data, image_data.get("api_key") == api_key
+    
+    def get_images_bulk(self, uuids: List[str], api_key: str) -> Dict[str, Tuple[Optional[Dict[str, Any]], bool]]:
+        """批次獲取多張圖片的元數據及權限（最多只讀取一次元數據檔案）"""
+        found = {}
+        missing = []
+        for uuid in uuids:
+            image_data = self._image_cache.get(uuid)
+            if image_data is None:
+                missing.append(uuid)
+            else:
+                found[uuid] = image_data
+        
+        if missing:
+            metadata = self._load_metadata()
+            for uuid in missing:
+                image_data = metadata.get(uuid)
+                if image_data is not None:
+                    self._image_cache[uuid] = image_data
+                    found[uuid] = image_data
+        
+        results = {}
+        for uuid in uuids:
+            image_data = found.get(uuid)
+            results[uuid] = (image_data, image_data is not None and image_data.get("api_key") == api_key)
+        return results
     
     def delete_image(self, uuid: str) -> bool:
         """刪除圖片元數據"""
-        metadata = self._load_metadata()
-        if uuid in metadata:
-            del metadata[uuid]
-            self._save_metadata(metadata)
-            return True
+        self.invalidate(uuid)
+        with self._lock:
+            metadata = self._load_metadata()
+            self._ensure_indexes(metadata)
+            if uuid in metadata:
+                image_data = metadata.pop(uuid)
+                self._append_log([{"op": "del", "uuid": uuid}])
+                self._unindex_record(uuid, image_data)
+                return True
         return False
     
+    def delete_images_bulk(self, uuids: List[str]) -> set:
+        """批次刪除圖片元數據（只追加寫入一次日誌），返回實際刪除的 UUID"""
+        with self._lock:
+            metadata = self._load_metadata()
+            self._ensure_indexes(metadata)
+            deleted = {}
+            for uuid in uuids:
+                self.invalidate(uuid)
+                image_data = metadata.pop(uuid, None)
+                if image_data is not None:
+                    deleted[uuid] = image_data
+            
+            if deleted:
+                self._append_log([{"op": "del", "uuid": uuid} for uuid in deleted])
+                for uuid, image_data in deleted.items():
+                    self._unindex_record(uuid, image_data)
+        return set(deleted)
+    
+    def invalidate(self, uuid: str):
+        """清除指定圖片的快取"""
+        self._image_cache.pop(uuid, None)
+    
     def list_images(self, api_key: str, user_path: Optional[str] = None, 
                    skip: int = 0, limit: int = 50) -> List[Dict[str, Any]]:
         """列出圖片（支援分頁和路徑篩選）"""
         metadata = self._load_metadata()
+        self._ensure_indexes(metadata)
+        entries = self._key_index.get(api_key, [])
+        
+        # 列表索引已按上傳時間排序，由尾端往前即為最新的在前
+        if user_path is None:
+            end = max(len(entries) - skip, 0)
+            page = [uuid for _, uuid in reversed(entries[max(end - limit, 0):end])]
+        else:
+            # 路徑篩選時只需掃描到湊滿本頁為止
+            page = []
+            matched = 0
+            for _, uuid in reversed(entries):
+                if not metadata[uuid].get("user_path", "").startswith(user_path):
+                    continue
+                matched += 1
+                if matched > skip:
+                    page.append(uuid)
+                    if len(page) >= limit:
+                        break
         
-        # 篩選屬於該 API Key 的圖片
-        filtered_images = []
-        for uuid, data in metadata.items():
-            if data.get("api_key") == api_key:
-                if user_path is None or data.get("user_path", "").startswith(user_path):
-                    image_info = data.copy()
-                    image_info["uuid"] = uuid
-                    filtered_images.append(image_info)
+        # 將本頁元數據預先載入快取（後續逐張存取時直接命中）
+        images = []
+        for uuid in page:
+            data = metadata[uuid]
+            self._image_cache[uuid] = data
+            image_info = data.copy()
+            image_info["uuid"] = uuid
+            images.append(image_info)
+        return images
+
+class SQLiteMetadataManager:
+    """以 SQLite 儲存圖片元數據（METADATA_BACKEND=sqlite），與 MetadataManager 提供相同介面"""
+    
+    _COLUMNS = (
+        "uuid, file_path, original_name, api_key, user_path, file_size, "
+        "format, width, height, upload_time, content_hash"
+    )
+    
+    def __init__(self):
+        os.makedirs(STORAGE_PATH, exist_ok=True)
+        # 去重上傳已引用、但元數據尚未寫入的檔案：file_path -> 保留數（只存在於本程序）
+        self._reserved_refs: Dict[str, int] = {}
+        # 連線在事件迴圈與工作執行緒間共用，以鎖序列化存取
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(METADATA_DB_FILE, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    uuid TEXT PRIMARY KEY,
+                    file_path TEXT NOT NULL,
+                    original_name TEXT NOT NULL,
+                    api_key TEXT NOT NULL,
+                    user_path TEXT NOT NULL,
+                    file_size INTEGER NOT NULL,
+                    format TEXT,
+                    width INTEGER,
+                    height INTEGER,
+                    upload_time TEXT NOT NULL,
+                    content_hash TEXT
+                )
+            """)
+            # 列表依 (api_key, upload_time) 分頁、依 (api_key, user_path) 篩選前綴、刪除時依 file_path 計算引用數
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_images_key_time ON images(api_key, upload_time DESC)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_images_key_path ON images(api_key, user_path)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_images_file_path ON images(file_path)")
+            # 上傳去重依 (api_key, content_hash) 查詢；多筆元數據可共用同一檔案，因此不設為 UNIQUE
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_images_key_hash ON images(api_key, content_hash) "
+                "WHERE content_hash IS NOT NULL"
+            )
+        self._import_file_metadata()
+    
+    def _import_file_metadata(self):
+        """資料庫為空且存在 JSON 元數據時，一次匯入既有資料"""
+        if not os.path.exists(METADATA_FILE):
+            return
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM images LIMIT 1").fetchone() is not None:
+                return
+            metadata = MetadataManager()._load_metadata()
+            with self._conn:
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO images ({self._COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [self._to_row(uuid, image_data) for uuid, image_data in metadata.items()]
+                )
+    
+    @staticmethod
+    def _to_row(uuid: str, image_data: Dict[str, Any]) -> tuple:
+        """將元數據轉為資料表的一列"""
+        dimensions = image_data.get("dimensions") or {}
+        return (
+            uuid, image_data["file_path"], image_data["original_name"], image_data["api_key"],
+            image_data["user_path"], image_data["file_size"], image_data.get("format"),
+            dimensions.get("width"), dimensions.get("height"), image_data.get("upload_time", ""),
+            image_data.get("content_hash")
+        )
+    
+    @staticmethod
+    def _from_row(row: tuple) -> Dict[str, Any]:
+        """將資料表的一列轉回與 JSON 儲存相同格式的元數據（不含 uuid）"""
+        image_data = {
+            "file_path": row[1],
+            "original_name": row[2],
+            "api_key": row[3],
+            "user_path": row[4],
+            "file_size": row[5],
+            "format": row[6],
+            "dimensions": {"width": row[7], "height": row[8]} if row[7] is not None else {},
+            "upload_time": row[9]
+        }
+        if row[10]:
+            image_data["content_hash"] = row[10]
+        return image_data
+    
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        """執行查詢並返回所有結果"""
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+    
+    def get_by_hash(self, api_key: str, content_hash: str) -> Optional[Dict[str, Any]]:
+        """以內容雜湊查詢同一 API Key 已上傳的相同圖片"""
+        rows = self._query(
+            f"SELECT {self._COLUMNS} FROM images WHERE api_key = ? AND content_hash = ? LIMIT 1",
+            (api_key, content_hash)
+        )
+        return self._from_row(rows[0]) if rows else None
+    
+    def file_ref_count(self, file_path: str) -> int:
+        """獲取實體檔案目前被多少筆元數據（含尚未寫入的保留引用）引用"""
+        refs = self._query("SELECT COUNT(*) FROM images WHERE file_path = ?", (file_path,))[0][0]
+        return refs + self._reserved_refs.get(file_path, 0)
+    
+    def reserve_file(self, file_path: str):
+        """保留檔案引用，直到引用它的元數據寫入為止（期間刪除其他元數據不會移除此檔案）"""
+        self._reserved_refs[file_path] = self._reserved_refs.get(file_path, 0) + 1
+    
+    def release_file(self, file_path: str):
+        """釋放 reserve_file 保留的檔案引用（元數據寫入後或寫入失敗時呼叫）"""
+        refs = self._reserved_refs.get(file_path, 0) - 1
+        if refs > 0:
+            self._reserved_refs[file_path] = refs
+        else:
+            self._reserved_refs.pop(file_path, None)
+    
+    def add_image(self, uuid: str, file_path: str, original_name: str, 
+                  api_key: str, user_path: str, file_size: int, 
+                  format_type: str, dimensions: Dict[str, int],
+                  content_hash: Optional[str] = None) -> Dict[str, Any]:
+        """添加圖片元數據"""
+        return self.add_images_bulk([{
+            "uuid": uuid,
+            "file_path": file_path,
+            "original_name": original_name,
+            "api_key": api_key,
+            "user_path": user_path,
+            "file_size": file_size,
+            "format_type": format_type,
+            "dimensions": dimensions,
+            "content_hash": content_hash
+        }])[uuid]
+    
+    def add_images_bulk(self, records: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """批次添加圖片元數據（單一交易），records 的欄位同 add_image 參數"""
+        if not records:
+            return {}
         
-        # 按上傳時間排序（最新的在前）
-        filtered_images.sort(key=lambda x: x.get("upload_time", ""), reverse=True)
+        added = {}
+        for record in records:
+            record = dict(record)
+            uuid = record.pop("uuid")
+            added[uuid] = MetadataManager._build_record(**record)
         
-        # 分頁
-        return filtered_images[skip:skip + limit]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO images ({self._COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [self._to_row(uuid, image_data) for uuid, image_data in added.items()]
+            )
+        return added
+    
+    def get_image(self, uuid: str) -> Optional[Dict[str, Any]]:
+        """獲取圖片元數據"""
+        rows = self._query(f"SELECT {self._COLUMNS} FROM images WHERE uuid = ?", (uuid,))
+        return self._from_row(rows[0]) if rows else None
     
-    def check_image_permission(self, uuid: str, api_key: str) -> bool:
-        """檢查圖片權限"""
+    def get_image_if_permitted(self, uuid: str, api_key: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """一次查詢獲取圖片元數據及權限，返回 (元數據或 None, 是否有權限)"""
         image_data = self.get_image(uuid)
-        if not image_data:
-            return False
-        return image_data.get("api_key") == api_key
+        if image_data is None:
+            return None, False
+        return image_data, image_data["api_key"] == api_key
+    
+    def get_images_bulk(self, uuids: List[str], api_key: str) -> Dict[str, Tuple[Optional[Dict[str, Any]], bool]]:
+        """批次獲取多張圖片的元數據及權限"""
+        found = {}
+        unique_uuids = list(dict.fromkeys(uuids))
+        # 分段查詢，避免超過 SQLite 的參數數量上限
+        for start in range(0, len(unique_uuids), _SQLITE_MAX_PARAMS):
+            chunk = unique_uuids[start:start + _SQLITE_MAX_PARAMS]
+            placeholders = ", ".join("?" * len(chunk))
+            for row in self._query(f"SELECT {self._COLUMNS} FROM images WHERE uuid IN ({placeholders})", tuple(chunk)):
+                found[row[0]] = self._from_row(row)
+        
+        results = {}
+        for uuid in uuids:
+            image_data = found.get(uuid)
+            results[uuid] = (image_data, image_data is not None and image_data["api_key"] == api_key)
+        return results
+    
+    def delete_image(self, uuid: str) -> bool:
+        """刪除圖片元數據"""
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM images WHERE uuid = ?", (uuid,)).rowcount > 0
+    
+    def delete_images_bulk(self, uuids: List[str]) -> set:
+        """批次刪除圖片元數據（單一交易），返回實際刪除的 UUID"""
+        deleted = set()
+        with self._lock, self._conn:
+            for uuid in dict.fromkeys(uuids):
+                if self._conn.execute("DELETE FROM images WHERE uuid = ?", (uuid,)).rowcount > 0:
+                    deleted.add(uuid)
+        return deleted
+    
+    def invalidate(self, uuid: str):
+        """清除指定圖片的快取（SQLite 後端不快取元數據）"""
+    
+    def list_images(self, api_key: str, user_path: Optional[str] = None, 
+                   skip: int = 0, limit: int = 50) -> List[Dict[str, Any]]:
+        """列出圖片（支援分頁和路徑篩選）"""
+        if user_path is None:
+            rows = self._query(
+                f"SELECT {self._COLUMNS} FROM images WHERE api_key = ? "
+                "ORDER BY upload_time DESC, uuid DESC LIMIT ? OFFSET ?",
+                (api_key, limit, skip)
+            )
+        else:
+            # 前綴篩選改寫為範圍條件，才能使用 (api_key, user_path) 索引
+            rows = self._query(
+                f"SELECT {self._COLUMNS} FROM images WHERE api_key = ? AND user_path >= ? AND user_path < ? "
+                "ORDER BY upload_time DESC, uuid DESC LIMIT ? OFFSET ?",
+                (api_key, user_path, user_path + _MAX_CHAR, limit, skip)
+            )
+        
+        images = []
+        for row in rows:
+            image_info = self._from_row(row)
+            image_info["uuid"] = row[0]
+            images.append(image_info)
+        return images
 
 class StorageService:
     """檔案儲存服務"""
     
     def __init__(self):
         self.storage_path = STORAGE_PATH
-        self.metadata_manager = MetadataManager()
+        self.metadata_manager = SQLiteMetadataManager() if METADATA_BACKEND == "sqlite" else MetadataManager()
+        # 已確認存在的目錄，避免每次保存都對路徑上每一層目錄做 stat
+        self._known_dirs: Set[str] = set()
     
     def _get_file_path(self, user_path: str, filename: str) -> str:
         """生成完整的檔案路徑"""
         full_path = os.path.join(self.storage_path, user_path)
-        os.makedirs(full_path, exist_ok=True)
+        # 多個執行緒同時建立同一目錄也無妨（exist_ok），因此不需要鎖
+        if full_path not in self._known_dirs:
+            os.makedirs(full_path, exist_ok=True)
+            self._known_dirs.add(full_path)
         return os.path.join(full_path, filename)
     
-    async def save_file(self, file_content: bytes, user_path: str, 
-                       filename: str) -> str:
-        """保存檔案到儲存系統"""
+    def _copy_to_storage(self, source: BinaryIO, user_path: str, filename: str) -> str:
+        """將檔案物件以固定大小區塊複製到儲存路徑"""
         file_path = self._get_file_path(user_path, filename)
-        
+        source.seek(0)
+        with open(file_path, 'wb') as f:
+            shutil.copyfileobj(source, f, UPLOAD_CHUNK_SIZE)
+        return file_path
+    
+    async def save_stream(self, source: BinaryIO, user_path: str, filename: str) -> str:
+        """以固定大小區塊串流保存檔案（例如 UploadFile.file），整個複製在單一工作執行緒中完成"""
         try:
-            async with aiofiles.open(file_path, 'wb') as f:
-                await f.write(file_content)
-            return file_path
+            return await asyncio.to_thread(self._copy_to_storage, source, user_path, filename)
         except Exception as e:
             raise ImageServiceError(
                 code="STORAGE_ERROR",
@@ -124,8 +713,44 @@ class StorageService:
                 details=str(e)
             )
     
-    async def read_file(self, file_path: str) -> bytes:
-        """從儲存系統讀取檔案"""
+    def _fsync_files(self, file_paths: List[str]):
+        """逐一將檔案內容強制寫入磁碟，並讓核心釋放這些已寫回的頁面快取"""
+        for file_path in file_paths:
+            fd = os.open(os.path.join(self.storage_path, file_path), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+                # 剛上傳的原圖很少立即被整檔讀取，不讓它們擠掉熱門檔案的快取（頁面寫回後才能釋放）
+                if _HAS_FADVISE:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    
+    async def sync_files(self, file_paths: List[str]):
+        """將多個已保存的檔案一次強制寫入磁碟（整批在單一工作執行緒中完成），應在寫入引用它們的元數據前呼叫"""
+        if not file_paths:
+            return
+        try:
+            await asyncio.to_thread(self._fsync_files, file_paths)
+        except Exception as e:
+            raise ImageServiceError(
+                code="STORAGE_ERROR",
+                message="Failed to sync files",
+                status_code=500,
+                details=str(e)
+            )
+    
+    @staticmethod
+    def content_hash(source: BinaryIO) -> str:
+        """以區塊讀取計算檔案內容雜湊（讀取後回到檔案開頭）"""
+        hasher = hashlib.blake2b(digest_size=16)
+        source.seek(0)
+        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+        source.seek(0)
+        return hasher.hexdigest()
+    
+    def get_full_path(self, file_path: str) -> str:
+        """獲取檔案在儲存系統中的完整路徑，檔案不存在時拋出錯誤"""
         full_path = os.path.join(self.storage_path, file_path)
         
         if not os.path.exists(full_path):
@@ -134,17 +759,7 @@ class StorageService:
                 message="File not found",
                 status_code=404
             )
-        
-        try:
-            async with aiofiles.open(full_path, 'rb') as f:
-                return await f.read()
-        except Exception as e:
-            raise ImageServiceError(
-                code="STORAGE_ERROR",
-                message="Failed to read file",
-                status_code=500,
-                details=str(e)
-            )
+        return full_path
     
     def delete_file(self, file_path: str) -> bool:
         """從儲存系統刪除檔案"""
@@ -162,8 +777,3 @@ class StorageService:
                 status_code=500,
                 details=str(e)
             )
-    
-    def file_exists(self, file_path: str) -> bool:
-        """檢查檔案是否存在"""
-        full_path = os.path.join(self.storage_path, file_path)
-        return os.path.exists(full_path)
\ No newline at end of file
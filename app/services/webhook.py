@@ -1,11 +1,17 @@
 import asyncio
+import random
 import httpx
-import json
-from typing import Optional, Dict, Any
-from datetime import datetime
+import orjson
+from collections import deque
+from typing import Optional, Dict, Any, List
 import logging
 
-from app.config import WEBHOOK_TIMEOUT, WEBHOOK_RETRY_ATTEMPTS, WEBHOOK_RETRY_DELAY
+from app.config import (
+    WEBHOOK_TIMEOUT, WEBHOOK_RETRY_ATTEMPTS, WEBHOOK_RETRY_DELAY, WEBHOOK_RETRY_MAX_DELAY,
+    WEBHOOK_DEAD_LETTER_SIZE,
+    WEBHOOK_MAX_CONNECTIONS, WEBHOOK_MAX_KEEPALIVE_CONNECTIONS, WEBHOOK_FANOUT_CONCURRENCY
+)
+from app.utils.timestamps import utc_timestamp
 
 logger = logging.getLogger(__name__)
 
@@ -13,7 +19,27 @@ class WebhookService:
     """Webhook 服務"""
     
     def __init__(self):
-        self.client = httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT)
+        # 共用連線池：webhook 重複使用 keep-alive 連線，並在伺服器支援時使用 HTTP/2 多工
+        self.client = httpx.AsyncClient(
+            timeout=WEBHOOK_TIMEOUT,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                max_keepalive_connections=WEBHOOK_MAX_KEEPALIVE_CONNECTIONS
+            )
+        )
+        # 重試耗盡仍失敗的 webhook（只保留最近的記錄）
+        self.dead_letters = deque(maxlen=WEBHOOK_DEAD_LETTER_SIZE)
+    
+    @staticmethod
+    def _retry_delay(attempt: int) -> float:
+        """指數退避加完整隨機抖動（在 0 與上限之間均勻取值），避免大量重試同時發生"""
+        return random.uniform(0, min(WEBHOOK_RETRY_MAX_DELAY, WEBHOOK_RETRY_DELAY * 2 ** attempt))
+    
+    @staticmethod
+    def _is_retryable(status_code: int) -> bool:
+        """只有伺服器錯誤及流量限制值得重試，其他 4xx 重送也不會成功"""
+        return status_code >= 500 or status_code == 429
     
     async def send_webhook(
         self, 
@@ -34,16 +60,18 @@ class WebhookService:
         if headers:
             default_headers.update(headers)
         
-        # 添加時間戳
-        payload["timestamp"] = datetime.utcnow().isoformat()
+        # 添加時間戳，並只序列化一次供每次重試使用
+        payload["timestamp"] = utc_timestamp()
+        body = orjson.dumps(payload)
         
+        last_error = None
         for attempt in range(retry_attempts):
             try:
                 logger.info(f"Sending webhook to {url} (attempt {attempt + 1})")
                 
                 response = await self.client.post(
                     url,
-                    json=payload,
+                    content=body,
                     headers=default_headers
                 )
                 
@@ -51,18 +79,79 @@ class WebhookService:
                     logger.info(f"Webhook sent successfully to {url}")
                     return True
                 else:
+                    last_error = f"HTTP {response.status_code}"
                     logger.warning(f"Webhook failed with status {response.status_code}: {response.text}")
+                    if not self._is_retryable(response.status_code):
+                        logger.error(f"Webhook to {url} rejected with non-retryable status {response.status_code}")
+                        break
                     
             except Exception as e:
+                last_error = str(e)
                 logger.error(f"Webhook error (attempt {attempt + 1}): {str(e)}")
-                
-                # 如果還有重試次數，等待後重試
-                if attempt < retry_attempts - 1:
-                    await asyncio.sleep(WEBHOOK_RETRY_DELAY)
-        
-        logger.error(f"Webhook failed after {retry_attempts} attempts to {url}")
+            
+            # 如果還有重試次數，等待後重試（可重試的狀態碼與網路例外皆同）
+            if attempt < retry_attempts - 1:
+                await asyncio.sleep(self._retry_delay(attempt))
+        else:
+            logger.error(f"Webhook failed after {retry_attempts} attempts to {url}")
+        self.dead_letters.append({
+            "url": url,
+            "payload": payload,
+            "error": last_error,
+            "failed_at": utc_timestamp()
+        })
+        logger.error(
+            f"Webhook dead-lettered: event={payload.get('event_type')} batch_id={payload.get('batch_id')} "
+            f"url={url} error={last_error}"
+        )
         return False
     
+    def get_dead_letters(self, batch_id: Optional[str] = None, api_key: Optional[str] = None) -> List[Dict[str, Any]]:
+        """獲取重試耗盡仍失敗的 webhook 記錄（可依批次 ID 及 API Key 篩選）"""
+        return [
+            entry for entry in self.dead_letters
+            if (batch_id is None or entry["payload"].get("batch_id") == batch_id)
+            and (api_key is None or entry["payload"].get("api_key") == api_key)
+        ]
+    
+    async def _fanout(
+        self,
+        urls: List[str],
+        payload: Dict[str, Any],
+        headers: Optional[Dict[str, str]] = None
+    ) -> List[bool]:
+        """以有限並行度將同一事件發送到多個 webhook URL，返回各 URL 是否成功"""
+        semaphore = asyncio.Semaphore(WEBHOOK_FANOUT_CONCURRENCY)
+        
+        async def send_one(url: str) -> bool:
+            async with semaphore:
+                # 每個 URL 使用自己的 payload 副本（send_webhook 會寫入時間戳）
+                return await self.send_webhook(url, dict(payload), headers)
+        
+        results = await asyncio.gather(*(send_one(url) for url in urls), return_exceptions=True)
+        return [result is True for result in results]
+    
+    @staticmethod
+    def _batch_progress_payload(batch_id: str, status: str, progress: Dict[str, Any], api_key: str) -> Dict[str, Any]:
+        """建立批次上傳進度事件"""
+        return {
+            "event_type": "batch_progress",
+            "batch_id": batch_id,
+            "status": status,
+            "progress": progress,
+            "api_key": api_key
+        }
+    
+    @staticmethod
+    def _batch_completed_payload(batch_id: str, results: Dict[str, Any], api_key: str) -> Dict[str, Any]:
+        """建立批次完成事件"""
+        return {
+            "event_type": "batch_completed",
+            "batch_id": batch_id,
+            "results": results,
+            "api_key": api_key
+        }
+    
     async def send_batch_progress_webhook(
         self,
         webhook_url: str,
@@ -73,16 +162,22 @@ class WebhookService:
         webhook_headers: Optional[Dict[str, str]] = None
     ) -> bool:
         """發送批次上傳進度 webhook"""
-        payload = {
-            "event_type": "batch_progress",
-            "batch_id": batch_id,
-            "status": status,
-            "progress": progress,
-            "api_key": api_key
-        }
-        
+        payload = self._batch_progress_payload(batch_id, status, progress, api_key)
         return await self.send_webhook(webhook_url, payload, webhook_headers)
     
+    async def send_batch_progress_fanout(
+        self,
+        webhook_urls: List[str],
+        batch_id: str,
+        status: str,
+        progress: Dict[str, Any],
+        api_key: str,
+        webhook_headers: Optional[Dict[str, str]] = None
+    ) -> List[bool]:
+        """同時發送批次上傳進度 webhook 給多個訂閱者"""
+        payload = self._batch_progress_payload(batch_id, status, progress, api_key)
+        return await self._fanout(webhook_urls, payload, webhook_headers)
+    
     async def send_batch_completed_webhook(
         self,
         webhook_url: str,
@@ -92,15 +187,21 @@ class WebhookService:
         webhook_headers: Optional[Dict[str, str]] = None
     ) -> bool:
         """發送批次完成 webhook"""
-        payload = {
-            "event_type": "batch_completed",
-            "batch_id": batch_id,
-            "results": results,
-            "api_key": api_key
-        }
-        
+        payload = self._batch_completed_payload(batch_id, results, api_key)
         return await self.send_webhook(webhook_url, payload, webhook_headers)
     
+    async def send_batch_completed_fanout(
+        self,
+        webhook_urls: List[str],
+        batch_id: str,
+        results: Dict[str, Any],
+        api_key: str,
+        webhook_headers: Optional[Dict[str, str]] = None
+    ) -> List[bool]:
+        """同時發送批次完成 webhook 給多個訂閱者"""
+        payload = self._batch_completed_payload(batch_id, results, api_key)
+        return await self._fanout(webhook_urls, payload, webhook_headers)
+    
     async def close(self):
         """關閉 HTTP 客戶端"""
         await self.client.aclose()
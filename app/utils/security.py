@@ -1,5 +1,6 @@
 from fastapi import HTTPException, Header
 from typing import Optional
+from functools import lru_cache
 import uuid
 import os
 from app.config import API_KEYS
@@ -13,6 +14,19 @@ class ImageServiceError(Exception):
         self.details = details
         super().__init__(self.message)
 
+def http_error(code: str, message: str, status_code: int, details: Optional[str] = None) -> HTTPException:
+    """建立統一錯誤格式的 HTTPException"""
+    return HTTPException(
+        status_code=status_code,
+        detail={
+            "error": {
+                "code": code,
+                "message": message,
+                "details": details
+            }
+        }
+    )
+
 def validate_api_key(api_key: str) -> dict:
     """驗證 API Key 並返回配置"""
     if not api_key:
@@ -32,10 +46,29 @@ def validate_api_key(api_key: str) -> dict:
     
     return API_KEYS[api_key]
 
+def compile_allowed_prefixes(allowed_prefix) -> tuple:
+    """將允許的路徑前綴（字串或列表）轉為 tuple，可直接傳給 str.startswith"""
+    if not isinstance(allowed_prefix, (list, tuple, set, frozenset)):
+        return (allowed_prefix,)
+    
+    # 排序後較短的前綴排在以它開頭的前綴之前；被其他前綴涵蓋的前綴不需要再比對
+    prefixes = []
+    for prefix in sorted(set(allowed_prefix)):
+        if not prefixes or not prefix.startswith(prefixes[-1]):
+            prefixes.append(prefix)
+    return tuple(prefixes)
+
+# 啟動時預先將每個 API Key 允許的前綴編譯為 tuple
+API_KEY_PREFIXES = {
+    key: compile_allowed_prefixes(config.get("allowed_prefix", ""))
+    for key, config in API_KEYS.items()
+}
+
 def validate_user_path(user_path: str, api_key_config: dict) -> bool:
     """驗證使用者路徑是否在允許的前綴範圍內"""
-    allowed_prefix = api_key_config.get("allowed_prefix", "")
-    if not user_path.startswith(allowed_prefix):
+    prefixes = api_key_config.get("_prefix_tuple") or compile_allowed_prefixes(api_key_config.get("allowed_prefix", ""))
+    if not user_path.startswith(prefixes):
+        allowed_prefix = api_key_config.get("allowed_prefix", "")
         raise ImageServiceError(
             code="PATH_FORBIDDEN",
             message="Path access denied",
@@ -48,12 +81,12 @@ def generate_uuid() -> str:
     """生成唯一的 UUID"""
     return str(uuid.uuid4())
 
+# 危險字符一律替換為底線（預先建立轉換表，一次掃描完成）
+_DANGEROUS_CHARS = '<>:"|?*\0'
+_FILENAME_TRANSLATION = str.maketrans(_DANGEROUS_CHARS, '_' * len(_DANGEROUS_CHARS))
+
+@lru_cache(maxsize=4096)
 def sanitize_filename(filename: str) -> str:
     """清理檔案名稱，避免路徑遍歷攻擊"""
-    # 移除路徑分隔符和特殊字符
-    filename = os.path.basename(filename)
-    # 移除或替換危險字符
-    dangerous_chars = ['<', '>', ':', '"', '|', '?', '*', '\0']
-    for char in dangerous_chars:
-        filename = filename.replace(char, '_')
-    return filename
\ No newline at end of file
+    # 移除路徑分隔符，再替換危險字符
+    return os.path.basename(filename).translate(_FILENAME_TRANSLATION)
\ No newline at end of file
@@ -0,0 +1,25 @@
+import time
+from functools import lru_cache
+from typing import Optional, Tuple
+from app.config import API_KEY_CACHE_TTL
+from app.utils.security import validate_api_key, compile_allowed_prefixes, API_KEY_PREFIXES, ImageServiceError
+
+@lru_cache(maxsize=1024)
+def _validate_with_bucket(api_key: str, time_bucket: int) -> Tuple[Optional[dict], Optional[tuple]]:
+    """依時間區間快取 API Key 驗證結果（失敗結果以 tuple 快取，不快取例外物件）"""
+    try:
+        config = dict(validate_api_key(api_key))
+    except ImageServiceError as e:
+        return None, (e.code, e.message, e.status_code, e.details)
+    
+    # 允許的路徑前綴 tuple（啟動時已編譯），供 str.startswith 一次比對
+    config["_prefix_tuple"] = API_KEY_PREFIXES.get(api_key) or compile_allowed_prefixes(config.get("allowed_prefix", ""))
+    return config, None
+
+def validate_api_key_cached(api_key: str) -> dict:
+    """驗證 API Key 並返回配置（TTL 內重複呼叫直接命中快取）"""
+    time_bucket = int(time.time() // API_KEY_CACHE_TTL)
+    config, error = _validate_with_bucket(api_key, time_bucket)
+    if error is not None:
+        raise ImageServiceError(*error)
+    return config
\ No newline at end of file
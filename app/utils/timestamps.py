@@ -0,0 +1,12 @@
+import time
+from datetime import datetime
+from functools import lru_cache
+
+@lru_cache(maxsize=1)
+def _format_second(second: int) -> str:
+    """將 epoch 秒數格式化為 ISO 字串"""
+    return datetime.utcfromtimestamp(second).isoformat()
+
+def utc_timestamp() -> str:
+    """目前 UTC 時間的 ISO 字串（精確到秒，同一秒內重複使用已格式化的結果）"""
+    return _format_second(int(time.time()))
\ No newline at end of file
@@ -1,15 +1,48 @@
 # import magic  # 簡化實作，不使用 python-magic
 from fastapi import UploadFile, HTTPException
+from typing import Optional
 from app.config import ALLOWED_EXTENSIONS, ALLOWED_MIME_TYPES, MAX_FILE_SIZE
 from app.utils.security import ImageServiceError
 
+# 驗證檔案類型所需的檔案開頭位元組數
+FILE_HEADER_SIZE = 16
+
+# 檔案開頭 3 個位元組 -> (完整簽章, MIME 類型)，一次查表取代逐一比對
+_FILE_SIGNATURES = {
+    b'\xff\xd8\xff': (b'\xff\xd8\xff', 'image/jpeg'),  # JPEG
+    b'\x89PN': (b'\x89PNG\r\n\x1a\n', 'image/png'),  # PNG
+    b'GIF': ((b'GIF87a', b'GIF89a'), 'image/gif'),  # GIF87a / GIF89a
+    b'RIF': (b'RIFF', 'image/webp'),  # WebP (需要進一步檢查)
+}
+
+# 辨識格式所需的最少位元組數（最長的簽章長度）
+_MIN_HEADER_SIZE = max(
+    len(signature)
+    for signatures, _ in _FILE_SIGNATURES.values()
+    for signature in (signatures if isinstance(signatures, tuple) else (signatures,))
+)
+
+def _detect_mime_type(header: bytes) -> Optional[str]:
+    """由檔案標頭判斷圖片 MIME 類型，無法辨識時返回 None"""
+    entry = _FILE_SIGNATURES.get(header[:3])
+    if entry is None:
+        return None
+    signature, mime_type = entry
+    if not header.startswith(signature):
+        return None
+    # RIFF 容器也用於 WAV/AVI 等格式，格式代碼必須是 WEBP
+    if mime_type == 'image/webp' and not header.startswith(b'WEBP', 8):
+        return None
+    return mime_type
+
 def validate_file_extension(filename: str) -> bool:
     """驗證檔案副檔名"""
     if not filename:
         return False
     
-    extension = filename.lower().split('.')[-1] if '.' in filename else ''
-    return extension in ALLOWED_EXTENSIONS
+    # 只取最後一個點之後的部分再轉小寫，不必分割及轉換整個檔名
+    dot = filename.rfind('.')
+    return dot != -1 and filename[dot + 1:].lower() in ALLOWED_EXTENSIONS
 
 def validate_file_size(file: UploadFile) -> bool:
     """驗證檔案大小"""
@@ -17,10 +50,13 @@ def validate_file_size(file: UploadFile) -> bool:
     # 實際檢查會在讀取檔案內容時進行
     return True
 
-def validate_file_content(file_content: bytes, filename: str) -> bool:
-    """驗證檔案內容和 MIME 類型"""
+def validate_file_content(file_content: bytes, filename: str, file_size: Optional[int] = None) -> bool:
+    """驗證檔案內容和 MIME 類型（file_content 可只傳入檔案標頭，並以 file_size 提供實際大小）"""
+    if file_size is None:
+        file_size = len(file_content)
+    
     # 檢查檔案大小
-    if len(file_content) > MAX_FILE_SIZE:
+    if file_size > MAX_FILE_SIZE:
         raise ImageServiceError(
             code="FILE_TOO_LARGE",
             message="File too large",
@@ -37,9 +73,14 @@ def validate_file_content(file_content: bytes, filename: str) -> bool:
             details=f"File type not supported. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
         )
     
-    # 檢查檔案頭（Magic Number）- 基本實作
+    # 檢查檔案頭（Magic Number）
+    validate_header(file_content)
+    return True
+
+def validate_header(header: bytes) -> str:
+    """只以檔案開頭位元組驗證圖片格式，返回偵測到的 MIME 類型"""
     # 這是一個簡化的實作，在生產環境中建議使用 python-magic
-    if len(file_content) < 8:
+    if len(header) < _MIN_HEADER_SIZE:
         raise ImageServiceError(
             code="INVALID_FILE_CONTENT",
             message="Invalid file content",
@@ -47,25 +88,7 @@ def validate_file_content(file_content: bytes, filename: str) -> bool:
             details="File appears to be corrupted or empty"
         )
     
-    # 簡單的 Magic Number 檢查
-    file_signatures = {
-        b'\xff\xd8\xff': 'image/jpeg',  # JPEG
-        b'\x89PNG\r\n\x1a\n': 'image/png',  # PNG
-        b'GIF87a': 'image/gif',  # GIF87a
-        b'GIF89a': 'image/gif',  # GIF89a
-        b'RIFF': 'image/webp',  # WebP (需要進一步檢查)
-    }
-    
-    detected_type = None
-    for signature, mime_type in file_signatures.items():
-        if file_content.startswith(signature):
-            detected_type = mime_type
-            break
-    
-    # WebP 需要額外檢查
-    if file_content.startswith(b'RIFF') and b'WEBP' in file_content[:12]:
-        detected_type = 'image/webp'
-    
+    detected_type = _detect_mime_type(header)
     if not detected_type or detected_type not in ALLOWED_MIME_TYPES:
         raise ImageServiceError(
             code="INVALID_FILE_CONTENT",
@@ -74,7 +97,7 @@ def validate_file_content(file_content: bytes, filename: str) -> bool:
             details="File content does not match expected image format"
         )
     
-    return True
+    return detected_type
 
 def validate_image_dimensions(width: int = None, height: int = None) -> bool:
     """驗證圖片尺寸參數"""